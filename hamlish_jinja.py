@@ -5,10 +5,30 @@
 #
 
 import re
+import copy
+import collections
+import hashlib
+import json
+import time
 import os.path
-
-from jinja2 import TemplateSyntaxError, nodes
+import fnmatch
+import asyncio
+import functools
+import gc
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+from jinja2 import TemplateSyntaxError, TemplateNotFound, Undefined, nodes
 from jinja2.ext import Extension
+from jinja2.loaders import BaseLoader
+from jinja2.parser import Parser
+from jinja2.utils import LRUCache
 
 __version__ = '0.3.4-dev'
 
@@ -20,6 +40,12 @@ begin_tag_m = re.compile(begin_tag_rx)
 end_tag_m = re.compile(end_tag_rx)
 
 
+#: An event from Hamlish.iter_events(). `type` is one of 'start_tag',
+#: 'end_tag', 'jinja_block', 'end_jinja_block', 'text', 'variable' and
+#: 'filter'.
+Event = collections.namedtuple('Event', 'type name data lineno')
+
+
 class HamlishExtension(Extension):
 
     def __init__(self, environment):
@@ -28,42 +54,814 @@ class HamlishExtension(Extension):
         environment.extend(
             hamlish_mode='compact',
             hamlish_file_extensions=('.haml',),
+            hamlish_case_sensitive_extensions=True,
             hamlish_indent_string='    ',
             hamlish_newline_string='\n',
             hamlish_debug=False,
             hamlish_enable_div_shortcut=False,
             hamlish_from_string=self._from_string,
+            hamlish_get_template_async=self._get_template_async,
+            hamlish_executor=None,
+            hamlish_from_string_cache=CodeCache(),
+            hamlish_from_string_batch=self._from_string_batch,
             hamlish_filters=None,
+            hamlish_filter_cache=FilterCache(),
+            hamlish_filter_executor=None,
+            hamlish_inline_includes=False,
+            hamlish_flatten_templates=(),
+            hamlish_constants=None,
+            hamlish_variants=None,
+            hamlish_prerender_static=False,
+            hamlish_minify_omit_closing_tags=False,
+            hamlish_whitespace_control=False,
+            hamlish_escape_static=False,
+            hamlish_get_variant=self._get_variant,
+            hamlish_dependencies=DependencyGraph(),
+            hamlish_conversion_cache=None,
+            hamlish_invalidate=self._invalidate,
+            hamlish_warm_up=self._warm_up,
         )
 
+        self._single_flight = SingleFlight()
+
+        # (file extensions, case sensitive, matcher function)
+        self._matcher = None
+
+        # The templates that has been inlined or flattened into each
+        # template, as a list of (name, uptodate) tuples.
+        self._embedded = {}
+
+    # The environment attributes that are methods of the extension
+    _environment_methods = {
+        'hamlish_from_string': '_from_string',
+        'hamlish_get_template_async': '_get_template_async',
+        'hamlish_from_string_batch': '_from_string_batch',
+        'hamlish_get_variant': '_get_variant',
+        'hamlish_invalidate': '_invalidate',
+        'hamlish_warm_up': '_warm_up',
+    }
+
+    def bind(self, environment):
+        # Used for overlays. The methods added to the environment are
+        # copied from the parent, so they are bound to the new extension.
+        rv = super(HamlishExtension, self).bind(environment)
+        rv._embedded = {}
+        rv._matcher = None
+
+        for attr, method in self._environment_methods.items():
+            if getattr(environment, attr, None) == getattr(self, method):
+                setattr(environment, attr, getattr(rv, method))
+
+        return rv
 
     def preprocess(self, source, name, filename=None):
-        if name is None or os.path.splitext(name)[1] not in \
-            self.environment.hamlish_file_extensions:
+        if not self._is_haml_template(name):
             return source
 
-        h = self.get_preprocessor(self.environment.hamlish_mode)
+        self._wrap_autoescape()
+        return self._convert(source, name, filename)
+
+
+    def _wrap_autoescape(self):
+        # With variants, a function like select_autoescape must get the
+        # name of the template without the variant, or it wouldn't match
+        # it. It is done when templates are converted, since the function
+        # and the variants may be set after the extension was loaded.
+        env = self.environment
+        autoescape = env.autoescape
+        if not env.hamlish_variants or not callable(autoescape):
+            return
+
+        if isinstance(autoescape, _VariantAutoescape):
+            if autoescape.extension is self:
+                return
+            autoescape = autoescape.autoescape
+
+        env.autoescape = _VariantAutoescape(self, autoescape)
+
+
+    def _is_haml_template(self, name):
+        if name is None:
+            return False
+        if self.environment.hamlish_variants:
+            name = self._split_variant(name)[0]
+        return self._get_matcher()(name)
+
+
+    def _get_matcher(self):
+        # The matcher is built again only when the options are changed
+        env = self.environment
+        extensions = env.hamlish_file_extensions
+        case_sensitive = env.hamlish_case_sensitive_extensions
+
+        matcher = self._matcher
+        if matcher is None or matcher[0] is not extensions or \
+                matcher[1] != case_sensitive:
+            matcher = self._matcher = (extensions, case_sensitive,
+                    _create_matcher(extensions, case_sensitive))
+
+        return matcher[2]
+
+
+    _variant_separator = '@'
+
+    def _split_variant(self, name):
+        """Splits a name like 'page.haml@rtl' in the template name and the
+        variant. The variant is None if the name isn't a known variant."""
+
+        variants = self.environment.hamlish_variants
+        if variants and name is not None:
+            base, sep, variant = name.rpartition(self._variant_separator)
+            if sep and variant in variants:
+                return base, variant
+
+        return name, None
+
+
+    def _get_variant(self, name, variant, parent=None, globals=None):
+
+        variants = self.environment.hamlish_variants
+        if not variants or variant not in variants:
+            raise ValueError('Unknown hamlish variant %r' % (variant,))
+
+        return self.environment.get_template(
+                name + self._variant_separator + variant, parent, globals)
+
+
+    def _get_constants(self, name):
+        # The constants used for the template, including the ones of the
+        # variant.
+
+        env = self.environment
+        variant = self._split_variant(name)[1]
+        if variant is None:
+            return env.hamlish_constants
+
+        constants = dict(env.hamlish_constants or {})
+        constants.update(env.hamlish_variants[variant])
+        return constants
+
+
+    def _convert(self, source, name, filename=None):
+
+        env = self.environment
+        key = self._get_conversion_key(source, name)
+
+        cache = env.hamlish_conversion_cache
+        if cache is None or name is None:
+            result, dependencies, embedded = self._convert_shared(
+                    key, source, name, filename)
+            if name is not None:
+                self._record(name, dependencies, embedded)
+            return result
+
+        # The dependencies are cached with the result, since the conversion
+        # may have been done by another environment sharing the cache.
+        entry = cache.get(name, key)
+        if entry is None:
+            entry = self._convert_shared(key, source, name, filename)
+            cache.set(name, key, entry)
+
+        result, dependencies, embedded = entry
+        self._record(name, dependencies, embedded)
+        return result
+
+
+    def _record(self, name, dependencies, embedded):
+        # Saves what was found when converting the template `name`, unless
+        # the caller is collecting it, see _collect().
+        records = getattr(_record_state, 'records', None)
+        if records is not None:
+            records.append((name, dependencies, embedded))
+            return
+
+        self.environment.hamlish_dependencies.set(name, dependencies)
+        self._embedded[name] = embedded
+
+
+    def _collect(self, func, *args):
+        # Calls func and returns its result with the (name, dependencies,
+        # embedded) tuples of the conversions done by it, instead of
+        # recording them.
+        previous = getattr(_record_state, 'records', None)
+        records = _record_state.records = []
         try:
-            return h.convert_source(source)
+            return func(*args), records
+        finally:
+            _record_state.records = previous
+
+
+    def _convert_shared(self, key, source, name, filename=None):
+        # Threads that load the same template with the same configuration
+        # at the same time share a single conversion instead of all doing
+        # the same work.
+        return self._single_flight.do((name, key),
+                self._convert_source, source, name, filename)
+
+
+    def _get_conversion_key(self, source, name):
+        return (hashlib.sha1(source.encode('utf-8')).hexdigest(),) + \
+            self._get_config_key(name)
+
+
+    def _get_config_key(self, name):
+        # The options that change how a template is converted
+        env = self.environment
+        filters = env.hamlish_filters
+        constants = self._get_constants(name)
+        flatten = self._split_variant(name)[0] in env.hamlish_flatten_templates
+        embeds = env.hamlish_inline_includes or flatten
+        return (
+            # Inlined and flattened templates are read from the loader, and
+            # the file extensions decide which of them are haml templates.
+            env.loader if embeds else None,
+            tuple(env.hamlish_file_extensions) if embeds else None,
+            env.hamlish_case_sensitive_extensions if embeds else None,
+            flatten,
+            env.block_start_string,
+            env.block_end_string,
+            env.variable_start_string,
+            env.variable_end_string,
+            env.comment_start_string,
+            env.comment_end_string,
+            env.hamlish_mode,
+            env.hamlish_indent_string,
+            env.hamlish_newline_string,
+            env.hamlish_debug,
+            env.hamlish_enable_div_shortcut,
+            env.hamlish_inline_includes,
+            env.hamlish_prerender_static,
+            env.hamlish_minify_omit_closing_tags,
+            env.hamlish_whitespace_control,
+            env.hamlish_escape_static,
+            frozenset(filters.items()) if filters else None,
+            repr(sorted(constants.items())) if constants else None,
+        )
+
+
+    def _invalidate(self, name):
+        """Drops the converted and compiled versions of the template `name`
+        and of all the templates that depend on it. Returns the names of the
+        invalidated templates."""
+
+        env = self.environment
+        names = env.hamlish_dependencies.dependents_closure(name) | set([name])
+
+        for n in names:
+            if env.hamlish_conversion_cache is not None:
+                env.hamlish_conversion_cache.invalidate(n)
+            if env.cache is not None and env.loader is not None:
+                try:
+                    del env.cache[weakref.ref(env.loader), n]
+                except KeyError:
+                    pass
+
+        return names
+
+
+    def _warm_up(self, names=None, freeze=True):
+        """Loads the haml templates `names`, or all the haml templates of
+        the loader, into the template cache of the environment. Meant to be
+        called before a server forks its workers, so they share the compiled
+        templates. Returns the names of the loaded templates."""
+
+        env = self.environment
+        if names is None:
+            names = sorted(n for n in env.list_templates()
+                    if self._is_haml_template(n))
+        else:
+            names = list(names)
+
+        # Make room for all the templates, or the first ones would be
+        # evicted by the last ones.
+        cache = env.cache
+        if isinstance(cache, LRUCache) and \
+                cache.capacity < len(cache) + len(names):
+            cache.capacity = len(cache) + len(names)
+
+        for name in names:
+            env.get_template(name)
+
+        # Frees the garbage left by the conversions, and moves the rest out
+        # of the collected generations, so the collector in the workers does
+        # not touch the pages shared with the parent.
+        gc.collect()
+        if freeze and hasattr(gc, 'freeze'):
+            gc.freeze()
+
+        return names
+
+
+    def _convert_source(self, source, name, filename=None):
+        env = self.environment
+        h = self.get_preprocessor(env.hamlish_mode)
+
+        tree = self._get_haml_tree(h, source, name, filename)
+
+        # Templates are not embedded in debug mode since it would break
+        # the line numbers.
+        base_name, variant = self._split_variant(name)
+        embedded = []
+        if env.hamlish_mode != 'debug':
+            if base_name in env.hamlish_flatten_templates:
+                tree = self._flatten(h, tree, [base_name], embedded)
+            if env.hamlish_inline_includes:
+                tree = self._inline_includes(h, tree, [base_name], embedded)
+
+            constants = self._get_constants(name)
+            if constants:
+                tree = self._remove_dead_branches(tree,
+                        self._hide_bound_names(tree, constants))
+
+            if env.hamlish_prerender_static and self._can_prerender():
+                tree = self._group_static_nodes(tree)
+
+        dependencies = []
+        if name is not None:
+            dependencies = h.get_dependencies(tree)
+            dependencies.extend(n for n, uptodate in embedded)
+            # Variants are invalidated with the template
+            if variant is not None:
+                dependencies.append(base_name)
+
+        return h.output.create(tree), frozenset(dependencies), embedded
+
+
+    def _get_haml_tree(self, h, source, name, filename=None):
+        try:
+            return h.get_haml_tree(source)
         except TemplateIndentationError as e:
             raise TemplateSyntaxError(e.message, e.lineno, name=name, filename=filename)
         except TemplateSyntaxError as e:
             raise TemplateSyntaxError(e.message, e.lineno, name=name, filename=filename)
 
 
+    _static_include_re = re.compile(
+        r'''^\s*(['"])([^'"]+)\1(\s+with\s+context)?\s*$''')
+
+    _static_extends_re = re.compile(r'''^\s*(['"])([^'"]+)\1\s*$''')
+
+    _block_re = re.compile(r'^\s*(\w+)(\s+(scoped|required))*\s*:?\s*$')
+
+    # Tags that would behave differently if an included template was
+    # inlined in the including template.
+    _inline_unsafe_tags = frozenset([
+        'extends', 'block', 'set', 'macro', 'import', 'from'
+    ])
+
+    def _inline_includes(self, h, nodes, stack, inlined):
+        # Replaces -include tags with a constant haml template name by the
+        # nodes of the included template.
+
+        result = []
+
+        for node in nodes:
+
+            tree = None
+            if isinstance(node, SelfClosingJinjaTag) and node.tag_name == 'include':
+                m = self._static_include_re.match(node.attrs)
+                if m and self._is_haml_template(m.group(2)):
+                    tree = self._load_partial(h, m.group(2), stack, inlined)
+
+            if tree is not None:
+                result.extend(tree)
+                continue
+
+            if node.children:
+                node.children = self._inline_includes(h, node.children, stack, inlined)
+            result.append(node)
+
+        return result
+
+
+    def _load_partial(self, h, name, stack, inlined):
+
+        # Recursive includes are left to jinja
+        loaded = self._load_tree(h, name, stack)
+        if loaded is None:
+            return None
+
+        tree, uptodate = loaded
+        if _contains_jinja_tags(tree, self._inline_unsafe_tags):
+            return None
+
+        inlined.append((name, uptodate))
+        return self._inline_includes(h, tree, stack + [name], inlined)
+
+
+    def _load_tree(self, h, name, stack):
+
+        loader = self.environment.loader
+        if loader is None or name in stack:
+            return None
+
+        try:
+            source, filename, uptodate = loader.get_source(self.environment, name)
+        except TemplateNotFound:
+            return None
+
+        return self._get_haml_tree(h, source, name, filename), uptodate
+
+
+    def _flatten(self, h, tree, stack, embedded):
+        # Resolves a constant -extends and the -block overrides of the
+        # template at compile time, so it is rendered without going through
+        # the inheritance chain. The tree is returned unchanged if it can't
+        # be done without changing how the template renders.
+
+        child = self._get_child_blocks(tree)
+        if child is None:
+            return tree
+
+        parent_name, blocks = child
+        loaded = self._load_tree(h, parent_name, stack)
+        if loaded is None:
+            return tree
+
+        parent_tree, uptodate = loaded
+        parent_embedded = []
+        parent_tree = self._flatten(h, parent_tree, stack + [parent_name],
+                parent_embedded)
+
+        try:
+            result = self._override_blocks(parent_tree, blocks)
+        except _NotFlattenable:
+            return tree
+
+        # Every block of the child must have found its place in the parent
+        names = [self._get_block_name(node) for node in _walk_nodes(result)]
+        names = [n for n in names if n is not None]
+        if len(names) != len(set(names)) or set(blocks) - set(names) or \
+                _contains_jinja_tags(result, ['extends']):
+            return tree
+
+        embedded.append((parent_name, uptodate))
+        embedded.extend(parent_embedded)
+
+        return result
+
+
+    def _get_child_blocks(self, tree):
+        # Returns the parent and the blocks of a template that only contains
+        # a constant -extends followed by blocks.
+
+        parent = None
+        top_blocks = []
+
+        for node in tree:
+            if isinstance(node, EmptyLine):
+                continue
+            if parent is None:
+                if not isinstance(node, SelfClosingJinjaTag) or \
+                        node.tag_name != 'extends':
+                    return None
+                m = self._static_extends_re.match(node.attrs)
+                if m is None or not self._is_haml_template(m.group(2)):
+                    return None
+                parent = m.group(2)
+            elif self._get_block_name(node) is None:
+                return None
+            else:
+                top_blocks.append(node)
+
+        if parent is None:
+            return None
+
+        # Nested blocks also override the blocks of the parent
+        blocks = {}
+        for node in _walk_nodes(top_blocks):
+            name = self._get_block_name(node)
+            if name is not None:
+                if name in blocks:
+                    return None
+                blocks[name] = node
+            elif _is_block_tag(node):
+                return None
+
+        return parent, blocks
+
+
+    def _get_block_name(self, node):
+
+        if not _is_block_tag(node):
+            return None
+
+        m = self._block_re.match(node.attrs)
+        return m.group(1) if m else None
+
+
+    def _override_blocks(self, nodes, blocks):
+
+        result = []
+
+        for node in nodes:
+
+            name = self._get_block_name(node)
+            if name in blocks:
+                override = blocks[name]
+                if _contains_block(node.children) and \
+                        _uses_super(override.children):
+                    raise _NotFlattenable()
+                # The nodes of the child template are copied so it is left
+                # unchanged if the flattening fails.
+                override = copy.copy(override)
+                override.children = self._replace_super(
+                        override.children, node.children)
+                result.append(override)
+                continue
+
+            if _is_block_tag(node):
+                # A block that can't be parsed might be overridden
+                if name is None or _uses_super(node.children):
+                    raise _NotFlattenable()
+            node.children = self._override_blocks(node.children, blocks)
+            result.append(node)
+
+        return result
+
+
+    def _replace_super(self, nodes, parent_content):
+        # Replaces `= super()` by the content of the parent block
+
+        result = []
+
+        for node in nodes:
+
+            if isinstance(node, JinjaVariable) and \
+                    node.data.strip() == 'super()':
+                result.extend(parent_content)
+                continue
+
+            # super() in a nested block refers to another parent block, and
+            # super() used in any other way can't be replaced.
+            if self._get_block_name(node) is not None or \
+                    isinstance(node, (InlineData, NestedTags)):
+                if _uses_super([node]):
+                    raise _NotFlattenable()
+            elif _mentions_super(node):
+                raise _NotFlattenable()
+
+            node = copy.copy(node)
+            node.children = self._replace_super(node.children, parent_content)
+            result.append(node)
+
+        return result
+
+
+    # Tags that bind names for their content
+    _scoped_binding_tags = frozenset(['for', 'macro', 'call', 'with'])
+
+    # Tags that bind names for the rest of the template
+    _binding_tags = frozenset(['set', 'import', 'from'])
+
+    def _remove_dead_branches(self, nodes, constants):
+        # Removes the branches of if/elif/else tags that can't be used with
+        # the values in `constants`.
+
+        result = []
+
+        for node in nodes:
+
+            if isinstance(node, ExtendedJinjaTag):
+                for branch in node.children:
+                    branch.children = self._remove_dead_branches(
+                            branch.children,
+                            self._hide_scoped_names(branch, constants))
+            elif node.children:
+                node.children = self._remove_dead_branches(
+                        node.children,
+                        self._hide_scoped_names(node, constants))
+
+            if isinstance(node, ExtendedJinjaTag):
+                branches = node.children
+            elif isinstance(node, JinjaTag) and node.tag_name == 'if':
+                branches = [node]
+            else:
+                result.append(node)
+                continue
+
+            if branches[0].tag_name != 'if':
+                result.append(node)
+                continue
+
+            result.extend(self._get_live_branches(branches, constants))
+
+        return result
+
+
+    def _hide_bound_names(self, nodes, constants):
+        # Removes the constants that are assigned or imported anywhere in
+        # the template, since the rules for where they are visible are
+        # not simple.
+        for node in _walk_nodes(nodes):
+            if isinstance(node, JinjaTag) and node.tag_name in self._binding_tags:
+                constants = self._hide_names(node, constants)
+        return constants
+
+
+    def _hide_scoped_names(self, node, constants):
+        # Removes the constants hidden by the names bound by a tag like
+        # -for or -macro, for the content of the tag.
+        if isinstance(node, JinjaTag) and \
+                node.tag_name in self._scoped_binding_tags:
+            return self._hide_names(node, constants)
+        return constants
+
+
+    def _hide_names(self, node, constants):
+
+        if not constants:
+            return constants
+
+        names = self._get_bound_names(node)
+        if names is None:
+            return {}
+
+        return dict((k, v) for k, v in constants.items() if k not in names)
+
+
+    def _get_bound_names(self, node):
+        # Returns the names bound by a jinja tag, or None if it can't be
+        # parsed.
+
+        env = self.environment
+        source = '%s %s %s %s' % (env.block_start_string, node.tag_name,
+                node.attrs, env.block_end_string)
+        if not isinstance(node, SelfClosingTag):
+            source += '%s end%s %s' % (env.block_start_string, node.tag_name,
+                    env.block_end_string)
+
+        try:
+            template = Parser(env, source).parse()
+        except TemplateSyntaxError:
+            return None
+
+        names = set(n.name for n in template.find_all(nodes.Name)
+                if n.ctx in ('store', 'param'))
+        for n in template.find_all(nodes.Import):
+            names.add(n.target)
+        for n in template.find_all(nodes.FromImport):
+            for name in n.names:
+                names.add(name[1] if isinstance(name, tuple) else name)
+
+        return names
+
+
+    def _get_live_branches(self, branches, constants):
+        # Returns the nodes to use in place of an if/elif/else chain
+
+        live = []
+
+        for branch in branches:
+
+            if branch.tag_name == 'else':
+                value = True
+            else:
+                value = self._evaluate_condition(branch.attrs, constants)
+
+            if value is _unknown:
+                tag_name = 'elif' if live else 'if'
+                live.append(JinjaTag(tag_name, branch.attrs))
+                live[-1].children = branch.children
+            elif value:
+                if not live:
+                    return branch.children
+                live.append(JinjaTag('else', ''))
+                live[-1].children = branch.children
+                break
+
+        if len(live) > 1:
+            node = ExtendedJinjaTag()
+            node.children = live
+            return [node]
+
+        return live
+
+
+    def _evaluate_condition(self, condition, constants):
+
+        try:
+            parser = Parser(self.environment, condition, state='variable')
+            expr = parser.parse_expression()
+            # Like jinja, allow a colon after the condition
+            parser.stream.skip_if('colon')
+            if not parser.stream.eos:
+                return _unknown
+        except TemplateSyntaxError:
+            # Left for jinja to report
+            return _unknown
+
+        value = _evaluate(expr, constants, self.environment)
+
+        if value is _unknown:
+            return _unknown
+        return bool(value)
+
+
+    def _can_prerender(self):
+        # Raw blocks would change the output with these options
+        env = self.environment
+        return not (env.trim_blocks or env.lstrip_blocks or
+                env.line_statement_prefix or env.line_comment_prefix)
+
+
+    def _group_static_nodes(self, nodes):
+        # Puts the runs of nodes that contain no jinja syntax in StaticBlocks
+
+        result = []
+        run = []
+
+        for node in nodes:
+
+            # Empty lines are not written, but they must not make a node
+            # that has no other children look like it has children.
+            if isinstance(node, EmptyLine):
+                result.append(node)
+                continue
+
+            if self._is_static(node):
+                run.append(node)
+                continue
+
+            if run:
+                result.append(StaticBlock(run))
+                run = []
+
+            if isinstance(node, ExtendedJinjaTag):
+                for branch in node.children:
+                    branch.children = self._group_static_nodes(branch.children)
+            elif node.children:
+                node.children = self._group_static_nodes(node.children)
+            result.append(node)
+
+        if run:
+            result.append(StaticBlock(run))
+
+        return result
+
+
+    def _is_static(self, node):
+
+        if isinstance(node, EmptyLine):
+            return True
+        if isinstance(node, (JinjaTag, ExtendedJinjaTag, JinjaVariable, FilterNode)):
+            return False
+
+        if isinstance(node, InlineData):
+            parts = [node.node, node.data]
+        elif isinstance(node, NestedTags):
+            parts = list(node.nodes)
+        elif isinstance(node, HTMLTag):
+            parts = [node.attrs]
+        elif isinstance(node, TextNode):
+            parts = [node.data]
+        else:
+            return False
+
+        for part in parts:
+            if isinstance(part, Node):
+                if not self._is_static(part):
+                    return False
+            elif self._has_jinja_syntax(part):
+                return False
+
+        return all(self._is_static(child) for child in node.children)
+
+
+    def _has_jinja_syntax(self, text):
+        env = self.environment
+        return env.block_start_string in text or \
+            env.variable_start_string in text or \
+            env.comment_start_string in text
+
+
+    def _embedded_uptodate(self, name):
+        "Returns False if one of the templates embedded in `name` has changed."
+        for dependency, uptodate in self._embedded.get(name, ()):
+            if uptodate is not None and not uptodate():
+                return False
+        return True
+
+
     def get_preprocessor(self, mode):
 
         placeholders = {
             'block_start_string': self.environment.block_start_string,
             'block_end_string': self.environment.block_end_string,
             'variable_start_string': self.environment.variable_start_string,
-            'variable_end_string': self.environment.variable_end_string}
+            'variable_end_string': self.environment.variable_end_string,
+            'comment_start_string': self.environment.comment_start_string,
+            'comment_end_string': self.environment.comment_end_string}
 
         if mode == 'compact':
             output = Output(
                 indent_string='',
                 newline_string='',
                 **placeholders)
+        elif mode == 'minified':
+            output = MinifiedOutput(
+                omit_closing_tags=self.environment.hamlish_minify_omit_closing_tags,
+                **placeholders)
         elif mode == 'debug':
             output = Output(
                 indent_string='   ',
@@ -75,22 +873,319 @@ class HamlishExtension(Extension):
                 indent_string=self.environment.hamlish_indent_string,
                 newline_string=self.environment.hamlish_newline_string,
                 debug=self.environment.hamlish_debug,
+                whitespace_control=self.environment.hamlish_whitespace_control,
                 **placeholders)
 
         return Hamlish(output, self.environment.hamlish_enable_div_shortcut,
-                       self.environment.hamlish_filters)
+                       self.environment.hamlish_filters,
+                       self.environment.hamlish_filter_cache,
+                       self.environment.hamlish_filter_executor,
+                       self.environment.hamlish_escape_static)
 
 
     def _from_string(self, source, globals=None, template_class=None):
         env = self.environment
         globals = env.make_globals(globals)
         cls = template_class or env.template_class
-        template_name = 'hamlish_from_string'
-        if env.hamlish_file_extensions:
-            template_name += env.hamlish_file_extensions[0]
+        template_name = self._get_from_string_name()
+
+        # Before the compile key is made, so it is the same after compiling
+        self._wrap_autoescape()
+
+        cache = env.hamlish_from_string_cache
+        if cache is None:
+            code = self._compile_snippet(source)[0]
+            return cls.from_code(env, code, globals, None)
+
+        # The templates inlined in the snippet are kept with the code, so it
+        # is compiled again when one of them has changed.
+        key = (hashlib.sha1(source.encode('utf-8')).hexdigest(),
+               self._get_compile_key(template_name))
+        entry = cache.get(key)
+        if entry is None or not all(uptodate is None or uptodate()
+                                    for name, uptodate in entry[1]):
+            entry = self._compile_snippet(source)
+            cache.set(key, entry)
+
+        return cls.from_code(env, entry[0], globals, None)
+
+
+    def _compile_snippet(self, source):
+        # The snippets all have the same name, so what is found when
+        # converting them is not recorded for the name. Returns the code
+        # and the templates embedded in it.
+        code, records = self._collect(self.environment.compile, source,
+                self._get_from_string_name())
+        return code, [e for r in records for e in r[2]]
+
+
+    def _get_compile_key(self, name):
+        # The options that change the code compiled for a template
+        env = self.environment
+        return self._get_config_key(name) + (
+            env.line_statement_prefix,
+            env.line_comment_prefix,
+            env.trim_blocks,
+            env.lstrip_blocks,
+            env.newline_sequence,
+            env.keep_trailing_newline,
+            env.autoescape,
+            env.optimized,
+            env.finalize,
+            env.is_async,
+        )
+
+
+    def _from_string_batch(self, sources, globals=None, template_class=None,
+                           executor=None):
+        """Compiles a list of sources like hamlish_from_string, in parallel
+        in `executor`. Each distinct source is only compiled once. The
+        executor must run the calls in this process.
+
+        Returns a list with the template for each source, in the same order,
+        or the exception raised if the source could not be compiled.
+        """
+
+        if executor is None:
+            executor = self.environment.hamlish_executor
+
+        own_executor = executor is None
+        if own_executor:
+            executor = ThreadPoolExecutor()
+        elif isinstance(executor, ProcessPoolExecutor):
+            # The templates are compiled for this environment, which can't
+            # be sent to another process.
+            raise TypeError('hamlish_from_string_batch can\'t use a '
+                            'ProcessPoolExecutor')
+
+        try:
+            futures = {}
+            for source in sources:
+                if source not in futures:
+                    futures[source] = executor.submit(
+                        self._from_string, source, globals, template_class)
+
+            results = {}
+            for source, future in futures.items():
+                try:
+                    results[source] = future.result()
+                except Exception as e:
+                    results[source] = e
+        finally:
+            if own_executor:
+                executor.shutdown()
+
+        return [results[source] for source in sources]
+
+
+    def _get_from_string_name(self):
+        # A name that is matched by the file extensions, so the source
+        # is converted.
+        for extension in self.environment.hamlish_file_extensions:
+            if _is_glob(extension):
+                name = extension.replace('*', 'hamlish_from_string', 1)
+            else:
+                name = 'hamlish_from_string' + extension
+            if self._get_matcher()(name):
+                return name
+        return 'hamlish_from_string.haml'
+
+
+    def _get_template_async(self, name, parent=None, globals=None):
+        # Loading, converting and compiling is done in an executor so
+        # that a cold load of a large template does not block the loop.
+        # It must be called from a coroutine.
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(
+            self.environment.hamlish_executor,
+            functools.partial(self._get_template_in_executor, loop,
+                              name, parent, globals))
+
+    def _get_template_in_executor(self, loop, name, parent, globals):
+        # Coroutine filters found while converting are run on the loop
+        _async_state.loop = loop
+        try:
+            return self.environment.get_template(name, parent, globals)
+        finally:
+            _async_state.loop = None
+
+
+class HamlishLoader(BaseLoader):
+    """Wraps another loader, so that templates are reloaded when a template
+    that was inlined in them at compile time has changed.
+
+    When a template has changed the templates that depend on it are also
+    invalidated, see HamlishExtension._invalidate(). It also loads the
+    variants of templates, see env.hamlish_variants.
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+
+    def get_source(self, environment, template):
+
+        extension = _get_extension(environment)
+
+        # Variants are loaded from the template they are made from
+        name = template
+        if extension is not None:
+            name = extension._split_variant(template)[0]
+
+        source, filename, uptodate = self.loader.get_source(environment, name)
+
+        def check():
+            if extension is None:
+                return uptodate is None or uptodate()
+            if (uptodate is None or uptodate()) and \
+                    extension._embedded_uptodate(template):
+                return True
+            extension._invalidate(template)
+            return False
+
+        return source, filename, check
+
+    def list_templates(self):
+        return self.loader.list_templates()
+
+
+def _get_extension(environment):
+    for extension in environment.extensions.values():
+        if isinstance(extension, HamlishExtension):
+            return extension
+    return None
+
+
+def _walk_nodes(nodes):
+    # Yields the nodes and all their descendants
+
+    for node in nodes:
+        if isinstance(node, InlineData):
+            yield node
+            node = node.node
+        if isinstance(node, NestedTags):
+            for n in _walk_nodes(node.nodes):
+                yield n
+        else:
+            yield node
+        for n in _walk_nodes(node.children):
+            yield n
+
+
+def _contains_jinja_tags(nodes, tag_names):
+    for node in _walk_nodes(nodes):
+        if isinstance(node, JinjaTag) and node.tag_name in tag_names:
+            return True
+    return False
+
+
+def _contains_block(nodes):
+    return _contains_jinja_tags(nodes, ['block'])
+
+
+def _mentions_super(node):
+    if isinstance(node, FilterNode):
+        return any('super' in line for line in node.lines)
+    for value in (getattr(node, 'attrs', None), node.__dict__.get('data')):
+        if isinstance(value, str) and 'super' in value:
+            return True
+    return False
+
+
+def _uses_super(nodes):
+    return any(_mentions_super(node) for node in _walk_nodes(nodes))
+
+
+def _is_block_tag(node):
+    return isinstance(node, JinjaTag) and \
+        not isinstance(node, SelfClosingTag) and node.tag_name == 'block'
+
+
+class _NotFlattenable(Exception):
+    pass
+
+
+# The value of an expression that can't be evaluated at compile time
+_unknown = object()
+
+_compare_operators = {
+    'eq': lambda a, b: a == b,
+    'ne': lambda a, b: a != b,
+    'gt': lambda a, b: a > b,
+    'gteq': lambda a, b: a >= b,
+    'lt': lambda a, b: a < b,
+    'lteq': lambda a, b: a <= b,
+    'in': lambda a, b: a in b,
+    'notin': lambda a, b: a not in b,
+}
+
+
+def _evaluate(node, constants, environment):
+    # Evaluates a simple expression that only uses constants. Returns
+    # _unknown for anything else.
+
+    if isinstance(node, nodes.Const):
+        return node.value
+
+    if isinstance(node, nodes.Name):
+        return constants.get(node.name, _unknown)
+
+    if isinstance(node, (nodes.List, nodes.Tuple)):
+        items = [_evaluate(n, constants, environment) for n in node.items]
+        if any(item is _unknown for item in items):
+            return _unknown
+        return items if isinstance(node, nodes.List) else tuple(items)
+
+    if isinstance(node, (nodes.Getattr, nodes.Getitem)):
+        obj = _evaluate(node.node, constants, environment)
+        if obj is _unknown:
+            return _unknown
+        if isinstance(node, nodes.Getattr):
+            value = environment.getattr(obj, node.attr)
         else:
-            template_name += '.haml'
-        return cls.from_code(env, env.compile(source, template_name), globals, None)
+            arg = _evaluate(node.arg, constants, environment)
+            if arg is _unknown:
+                return _unknown
+            value = environment.getitem(obj, arg)
+        return _unknown if isinstance(value, Undefined) else value
+
+    if isinstance(node, nodes.Not):
+        value = _evaluate(node.node, constants, environment)
+        return value if value is _unknown else not value
+
+    if isinstance(node, (nodes.And, nodes.Or)):
+        left = _evaluate(node.left, constants, environment)
+        right = _evaluate(node.right, constants, environment)
+        short = (lambda v: not v) if isinstance(node, nodes.And) else bool
+        if left is not _unknown and short(left):
+            return left
+        if left is _unknown:
+            if right is not _unknown and short(right):
+                return right
+            return _unknown
+        return right
+
+    if isinstance(node, nodes.Compare):
+        left = _evaluate(node.expr, constants, environment)
+        for operand in node.ops:
+            right = _evaluate(operand.expr, constants, environment)
+            if left is _unknown or right is _unknown or \
+                    operand.op not in _compare_operators:
+                return _unknown
+            try:
+                if not _compare_operators[operand.op](left, right):
+                    return False
+            except TypeError:
+                return _unknown
+            left = right
+        return True
+
+    if isinstance(node, nodes.Test) and node.name in ('defined', 'undefined') \
+            and not node.args:
+        if _evaluate(node.node, constants, environment) is _unknown:
+            return _unknown
+        return node.name == 'defined'
+
+    return _unknown
 
 
 class HamlishTagExtension(HamlishExtension):
@@ -114,6 +1209,23 @@ class HamlishTagExtension(HamlishExtension):
         ]
 
     def preprocess(self, source, name, filename = None):
+        # Most templates don't contain any haml tags
+        if 'haml' not in source:
+            return source
+
+        # The dependencies of all the blocks are recorded together
+        ret_source, records = self._collect(self._convert_blocks, source,
+                name, filename)
+
+        if records:
+            dependencies = frozenset().union(*[r[1] for r in records])
+            embedded = [e for r in records for e in r[2]]
+            self._record(name, dependencies, embedded)
+
+        return ret_source
+
+    def _convert_blocks(self, source, name, filename):
+
         ret_source = ''
         start_pos = 0
 
@@ -129,13 +1241,8 @@ class HamlishTagExtension(HamlishExtension):
 
                 haml_source = source[tag_match.end() : end_tag.start()]
 
-                h = self.get_preprocessor(self.environment.hamlish_mode)
-                try:
-                    ret_source += source[start_pos : tag_match.start()] + h.convert_source(haml_source)
-                except TemplateIndentationError as e:
-                    raise TemplateSyntaxError(e.message, e.lineno, name = name, filename = filename)
-                except TemplateSyntaxError as e:
-                    raise TemplateSyntaxError(e.message, e.lineno, name = name, filename = filename)
+                ret_source += source[start_pos : tag_match.start()] + \
+                    self._convert(haml_source, name, filename)
 
                 start_pos = end_tag.end()
             else:
@@ -149,6 +1256,533 @@ class TemplateIndentationError(TemplateSyntaxError):
     pass
 
 
+def _is_glob(pattern):
+    return any(c in pattern for c in '*?[')
+
+
+def _create_matcher(extensions, case_sensitive=True):
+    """Returns a function that tells if a template name ends with one of the
+    extensions or matches one of the glob patterns in `extensions`."""
+
+    if not case_sensitive:
+        extensions = [e.lower() for e in extensions]
+
+    suffixes = tuple(e for e in extensions if not _is_glob(e))
+    globs = [e for e in extensions if _is_glob(e)]
+    glob_re = re.compile('|'.join(fnmatch.translate(g) for g in globs)) \
+        if globs else None
+
+    def match(name):
+        if not case_sensitive:
+            name = name.lower()
+        if name.endswith(suffixes):
+            return True
+        return glob_re is not None and glob_re.match(name) is not None
+
+    return match
+
+
+def cacheable_filter(f):
+    """Marks a filter as pure, so that its result for a given content can
+    be cached and reused."""
+    f.hamlish_cacheable = True
+    return f
+
+
+def parallel_filter(f):
+    """Marks a filter as safe to run in the filter executor, in parallel
+    with the other filters in the template."""
+    f.hamlish_parallel = True
+    return f
+
+
+def streaming_filter(f):
+    """Marks a filter as taking an iterator of the lines in the block and
+    returning an iterable of output chunks, instead of working on strings."""
+    f.hamlish_streaming = True
+    return f
+
+
+# Collects what is found when converting templates in the current thread,
+# see HamlishExtension._collect().
+_record_state = threading.local()
+
+
+# Holds the event loop of the async entry point that is converting
+# templates in the current thread.
+_async_state = threading.local()
+
+
+class FilterCache(object):
+    """Caches the results of filters marked with cacheable_filter().
+
+    The results are kept in a LRU cache with room for `size` results, keyed
+    by the filter and a hash of the content. If `store` is given it should
+    be a mapping with string keys and values, like a shelve, where the results
+    are also saved so they can be reused by other processes or after a
+    restart. Only filters that can be found by name (not lambdas or nested
+    functions) are saved in the store.
+    """
+
+    def __init__(self, size=256, store=None):
+        self._cache = LRUCache(size)
+        self._store_lock = threading.Lock()
+        self.store = store
+
+    def apply(self, filter, content):
+        """Returns the result of `filter(content)`, from the cache if
+        possible."""
+
+        result = self.get(filter, content)
+        if result is None:
+            result = filter(content)
+            self.set(filter, content, result)
+        return result
+
+    def get(self, filter, content):
+        """Returns the cached result or None."""
+
+        if not getattr(filter, 'hamlish_cacheable', False):
+            return None
+
+        digest = self._get_digest(content)
+
+        result = self._cache.get((filter, digest))
+        if result is not None:
+            return result
+
+        store_key = self._get_store_key(filter, digest)
+        if store_key is not None:
+            with self._store_lock:
+                result = self.store.get(store_key)
+            if result is not None:
+                self._cache[filter, digest] = result
+
+        return result
+
+    def set(self, filter, content, result):
+
+        if not getattr(filter, 'hamlish_cacheable', False):
+            return
+
+        digest = self._get_digest(content)
+        self._cache[filter, digest] = result
+
+        store_key = self._get_store_key(filter, digest)
+        if store_key is not None:
+            with self._store_lock:
+                self.store[store_key] = result
+
+    def clear(self):
+        self._cache.clear()
+
+    def _get_digest(self, content):
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    def _get_store_key(self, filter, digest):
+
+        if self.store is None:
+            return None
+
+        name = getattr(filter, '__qualname__', None) or \
+            getattr(filter, '__name__', None)
+        if name is None or '<' in name:
+            return None
+
+        return '%s.%s:%s' % (filter.__module__, name, digest)
+
+
+class DependencyGraph(object):
+    """The static dependencies between templates, recorded when the
+    templates are converted.
+
+    A template depends on the templates it extends, includes or imports
+    with a constant name, and on the templates inlined in it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._dependencies = {}
+        self._dependents = {}
+
+    def set(self, name, dependencies):
+        "Replaces the dependencies of the template `name`."
+        with self._lock:
+            self._remove(name)
+            self._dependencies[name] = frozenset(dependencies)
+            for dependency in self._dependencies[name]:
+                self._dependents.setdefault(dependency, set()).add(name)
+
+    def remove(self, name):
+        with self._lock:
+            self._remove(name)
+
+    def _remove(self, name):
+        for dependency in self._dependencies.pop(name, ()):
+            dependents = self._dependents[dependency]
+            dependents.discard(name)
+            if not dependents:
+                del self._dependents[dependency]
+
+    def clear(self):
+        with self._lock:
+            self._dependencies.clear()
+            self._dependents.clear()
+
+    def __contains__(self, name):
+        return name in self._dependencies
+
+    def templates(self):
+        "Returns the names of the templates that have been recorded."
+        with self._lock:
+            return frozenset(self._dependencies)
+
+    def dependencies(self, name):
+        "Returns the templates that `name` uses directly."
+        with self._lock:
+            return self._dependencies.get(name, frozenset())
+
+    def dependents(self, name):
+        "Returns the templates that use `name` directly."
+        with self._lock:
+            return frozenset(self._dependents.get(name, ()))
+
+    def closure(self, name):
+        """Returns all the templates that `name` uses, directly or through
+        other templates."""
+        with self._lock:
+            return self._walk(name, self._dependencies)
+
+    def dependents_closure(self, name):
+        """Returns all the templates that use `name`, directly or through
+        other templates."""
+        with self._lock:
+            return self._walk(name, self._dependents)
+
+    def _walk(self, name, edges):
+        seen = set()
+        stack = [name]
+        while stack:
+            for other in edges.get(stack.pop(), ()):
+                if other not in seen and other != name:
+                    seen.add(other)
+                    stack.append(other)
+        return frozenset(seen)
+
+
+class ConversionCache(object):
+    """Caches converted templates, so that a template is not converted
+    again when it is reloaded without changes.
+
+    The entries are keyed by the template name and a key made from the
+    source and the configuration of the environment, so the same cache can
+    be shared by environments with different configurations. An entry is a
+    (result, dependencies, embedded templates) tuple.
+
+    If `store` is given it should be a mapping with string keys and values,
+    like a SQLiteStore, where the entries are also saved so they can be used
+    by other processes. Templates with inlined or flattened templates, and
+    configurations with lambdas or nested functions, are not saved.
+    """
+
+    def __init__(self, size=256, store=None):
+        self._cache = LRUCache(size)
+        self._lock = threading.Lock()
+        self._store_lock = threading.Lock()
+        self.store = store
+        # The keys used for each name
+        self._keys = {}
+
+    def get(self, name, key):
+
+        entry = self._cache.get((name, key))
+        if entry is not None:
+            return entry
+
+        store_key = self._get_store_key(name, key)
+        if store_key is not None:
+            with self._store_lock:
+                data = self.store.get(store_key)
+            if data is not None:
+                result, dependencies = json.loads(data)
+                entry = (result, frozenset(dependencies), [])
+                self._set(name, key, entry)
+
+        return entry
+
+    def set(self, name, key, entry):
+
+        self._set(name, key, entry)
+
+        store_key = self._get_store_key(name, key)
+        if store_key is not None and not entry[2]:
+            data = json.dumps([entry[0], sorted(entry[1])])
+            with self._store_lock:
+                self.store[store_key] = data
+
+    def _get_store_key(self, name, key):
+
+        if self.store is None:
+            return None
+
+        data = _get_stable_repr((name, key))
+        if data is None:
+            return None
+
+        return 'conversion:' + hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    def _set(self, name, key, entry):
+        with self._lock:
+            self._cache[name, key] = entry
+            # Forget the keys of entries that has been evicted
+            keys = set(k for k in self._keys.get(name, ())
+                if (name, k) in self._cache)
+            keys.add(key)
+            self._keys[name] = keys
+
+    def invalidate(self, name):
+        """Drops the entries for the template `name` for all
+        configurations."""
+        with self._lock:
+            for key in self._keys.pop(name, ()):
+                try:
+                    del self._cache[name, key]
+                except KeyError:
+                    pass
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._keys.clear()
+
+
+def _get_stable_repr(value):
+    # Returns a string for the value that is the same in all processes, or
+    # None if there is none.
+
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return repr(value)
+
+    if isinstance(value, (tuple, frozenset)):
+        parts = [_get_stable_repr(v) for v in value]
+        if None in parts:
+            return None
+        if isinstance(value, frozenset):
+            parts.sort()
+        return '(%s)' % ', '.join(parts)
+
+    name = getattr(value, '__qualname__', None)
+    if callable(value) and name is not None and '<' not in name:
+        return '%s.%s' % (value.__module__, name)
+
+    return None
+
+
+class SQLiteStore(object):
+    """A mapping with string keys and values saved in a SQLite database, so
+    it can be shared by the processes on a host, like the workers of a
+    pre-fork server.
+
+    Several processes can read and write at the same time. When there are
+    more than `max_entries` entries the least recently used are removed. The
+    time an entry was used is only updated when it is older than
+    `touch_interval` seconds, so most reads don't write to the database.
+    """
+
+    def __init__(self, path, max_entries=10000, timeout=30, touch_interval=60):
+        if sqlite3 is None:
+            raise RuntimeError('SQLiteStore needs the sqlite3 module')
+
+        self.path = path
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.touch_interval = touch_interval
+        self._local = threading.local()
+
+        self._execute('CREATE TABLE IF NOT EXISTS hamlish_store '
+                      '(key TEXT PRIMARY KEY, value, used REAL)')
+        self._execute('CREATE INDEX IF NOT EXISTS hamlish_store_used '
+                      'ON hamlish_store (used)')
+
+    def _connect(self):
+        # Connections can't be shared by threads, or by processes after a
+        # fork.
+        pid = os.getpid()
+        if getattr(self._local, 'pid', None) != pid:
+            conn = sqlite3.connect(self.path, timeout=self.timeout,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+            self._local.pid = pid
+        return self._local.conn
+
+    def _execute(self, sql, args=()):
+        return self._connect().execute(sql, args)
+
+    def get(self, key, default=None):
+        row = self._execute('SELECT value, used FROM hamlish_store '
+                            'WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return default
+
+        now = time.time()
+        if now - row[1] >= self.touch_interval:
+            self._execute('UPDATE hamlish_store SET used = ? WHERE key = ?',
+                          (now, key))
+        return row[0]
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('INSERT OR REPLACE INTO hamlish_store '
+                         '(key, value, used) VALUES (?, ?, ?)',
+                         (key, value, time.time()))
+            conn.execute('DELETE FROM hamlish_store WHERE key IN '
+                         '(SELECT key FROM hamlish_store ORDER BY used DESC '
+                         'LIMIT -1 OFFSET ?)', (self.max_entries,))
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def __delitem__(self, key):
+        if self._execute('DELETE FROM hamlish_store WHERE key = ?',
+                         (key,)).rowcount == 0:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return self._execute('SELECT 1 FROM hamlish_store WHERE key = ?',
+                             (key,)).fetchone() is not None
+
+    def __len__(self):
+        return self._execute('SELECT COUNT(*) FROM hamlish_store').fetchone()[0]
+
+    def clear(self):
+        self._execute('DELETE FROM hamlish_store')
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            conn.close()
+        self._local.pid = None
+
+
+class CodeCache(object):
+    """A LRU cache with room for `size` compiled templates, used by
+    hamlish_from_string so the same source is only compiled once. The
+    entries are (code, embedded templates) tuples."""
+
+    def __init__(self, size=256):
+        self._cache = LRUCache(size)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        code = self._cache.get(key)
+        with self._lock:
+            if code is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return code
+
+    def set(self, key, code):
+        with self._lock:
+            if key not in self._cache and \
+                    len(self._cache) >= self._cache.capacity:
+                self.evictions += 1
+            self._cache[key] = code
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        "Returns a dict with the number of hits, misses, evictions and entries."
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._cache),
+            }
+
+
+class _VariantAutoescape(object):
+    # Calls the autoescape function of the environment with the name of the
+    # template without the variant.
+
+    def __init__(self, extension, autoescape):
+        self.extension = extension
+        self.autoescape = autoescape
+
+    def __call__(self, name):
+        return self.autoescape(self.extension._split_variant(name)[0])
+
+
+class SingleFlight(object):
+    """Makes sure that a function is only running once for a given key.
+
+    If a call with the same key is already running in another thread, the
+    caller waits for it to finish and gets the same result (or exception)
+    instead of doing the work again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, *args):
+
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            if not call.finished:
+                # The leader was interrupted, like by KeyboardInterrupt,
+                # so the work is done again.
+                return self.do(key, func, *args)
+            return call.result
+
+        try:
+            call.result = func(*args)
+            call.finished = True
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+        return call.result
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.finished = False
+        self.result = None
+        self.error = None
+
+
 class Hamlish(object):
 
     INLINE_DATA_SEP = ' << '
@@ -168,38 +1802,57 @@ class Hamlish(object):
 
 
 
+    # The class level tables are immutable and all state used during a
+    # conversion is kept local to the call, so a Hamlish instance can be
+    # shared between threads.
+
     #Which haml tags that can contain inline data
-    _inline_data_tags = set([HTML_TAG, JINJA_TAG])
+    _inline_data_tags = frozenset([HTML_TAG, JINJA_TAG])
 
     #Which html tags that can start a line with nested tags
-    _nested_tags = set([HTML_TAG, JINJA_TAG])
+    _nested_tags = frozenset([HTML_TAG, JINJA_TAG])
 
 
     _div_shorcut_re = re.compile(r'^(\s*)([#\.])', re.M)
 
+    _indent_re = re.compile(r'^(\s+)')
+
+    _tag_re = re.compile(r'^(\w+)(.*)$')
+
+    _shortcut_extra_attrs_re = re.compile(r'^([\.#0-9A-Za-z\-]+)\((.+?)\)$')
+
+    _shortcut_split_re = re.compile(r'([\.#])')
 
+    _template_name_re = re.compile(r'''^\s*(['"])([^'"]+)\1''')
 
-    _self_closing_jinja_tags = set([
+
+    _self_closing_jinja_tags = frozenset([
         'include', 'extends', 'import', 'set', 'from', 'do', 'break',
         'continue'
     ])
 
-    _self_closing_html_tags = set([
+    _dependency_tags = frozenset(['include', 'extends', 'import', 'from'])
+
+    _self_closing_html_tags = frozenset([
         'br', 'img', 'link', 'hr', 'meta', 'input'
     ])
 
 
     _extended_tags = {
-        'else' : set(['if', 'for']),
-        'elif' : set(['if']),
-        'pluralize' : set(['trans'])
+        'else' : frozenset(['if', 'for']),
+        'elif' : frozenset(['if']),
+        'pluralize' : frozenset(['trans'])
     }
 
 
-    def __init__(self, output, use_div_shortcut=False, filters=None):
+    def __init__(self, output, use_div_shortcut=False, filters=None,
+                 filter_cache=None, filter_executor=None, escape_static=False):
         self.output = output
         self._use_div_shortcut = use_div_shortcut
         self._filters = filters or {}
+        self._filter_cache = filter_cache
+        self._filter_executor = filter_executor
+        self._escape_static = escape_static
 
     def convert_source(self, source):
 
@@ -207,6 +1860,111 @@ class Hamlish(object):
         return self.output.create(tree)
 
 
+    def convert_file(self, source_file, output_file):
+        """Converts the haml read from the file object `source_file` and
+        writes the result to the file object `output_file`.
+
+        The source is read line by line and the output is written as soon
+        as it is known, so only the currently open tags are kept in memory.
+        """
+
+        source_lines = self._iter_source_lines(self._read_lines(source_file))
+        self.output.create_stream(self._iter_nodes(source_lines), output_file)
+
+
+
+    def iter_events(self, source):
+        """Parses the source and lazily yields an Event for each part of it.
+
+        `source` can be a string or a file object. The events are generated
+        directly from the parsed lines, without building the node tree:
+
+        - start_tag/end_tag: a html tag, `name` is the tag name and `data` the
+          attributes of the start tag. Self closing tags are ended at once.
+        - jinja_block: a jinja tag, `name` is the tag and `data` the rest of
+          the tag. Jinja tags that have an end tag are followed by an
+          end_jinja_block event. For chains like if/elif/else only the first
+          tag gets an end event.
+        - text: static text.
+        - variable: a jinja variable, `data` is the expression.
+        - filter: a filter block, `name` is the filter name and `data` the
+          unfiltered content of the block.
+        """
+
+        if hasattr(source, 'read'):
+            source_lines = self._read_lines(source)
+        else:
+            source_lines = source.rstrip().split('\n')
+
+        # (depth, end events) for the currently open nodes
+        open_nodes = []
+
+        # Only the content of the filters is used, so they are not started
+        for lineno, depth, node, extends in self._iter_nodes(
+                self._iter_source_lines(source_lines), start_filters=False):
+
+            if isinstance(node, EmptyLine):
+                continue
+
+            while open_nodes and open_nodes[-1][0] > depth or \
+                    open_nodes and open_nodes[-1][0] == depth and not extends:
+                for event in open_nodes.pop()[1]:
+                    yield event
+
+            end_events = []
+            if extends:
+                # The end of the chain is moved to the new tag.
+                end_events = open_nodes.pop()[1]
+
+            if isinstance(node, InlineData):
+                start, end = self._get_events(node.node, lineno)
+                start.append(Event('text', None, node.data, lineno))
+                start, end = start + end, []
+            else:
+                start, end = self._get_events(node, lineno)
+
+            for event in start:
+                yield event
+
+            open_nodes.append((depth, end + end_events))
+
+        while open_nodes:
+            for event in open_nodes.pop()[1]:
+                yield event
+
+
+    def _get_events(self, node, lineno):
+        # Returns the events for the start and the end of the node
+
+        if isinstance(node, NestedTags):
+            start, end = [], []
+            for n in node.nodes:
+                s, e = self._get_events(n, lineno)
+                start.extend(s)
+                end[:0] = e
+            return start, end
+
+        elif isinstance(node, HTMLTag):
+            start = [Event('start_tag', node.tag_name, node.attrs.strip(), lineno)]
+            end = [Event('end_tag', node.tag_name, None, lineno)]
+            if isinstance(node, SelfClosingTag):
+                return start + end, []
+            return start, end
+
+        elif isinstance(node, JinjaTag):
+            start = [Event('jinja_block', node.tag_name, node.attrs.strip(), lineno)]
+            if isinstance(node, SelfClosingTag):
+                return start, []
+            return start, [Event('end_jinja_block', node.tag_name, None, lineno)]
+
+        elif isinstance(node, JinjaVariable):
+            return [Event('variable', None, node.data.strip(), lineno)], []
+
+        elif isinstance(node, FilterNode):
+            return [Event('filter', node.name, node.content, lineno)], []
+
+        return [Event('text', None, node.data, lineno)], []
+
 
     def get_haml_tree(self, source):
 
@@ -215,9 +1973,59 @@ class Hamlish(object):
 
 
 
+    def get_dependencies(self, nodes):
+        """Returns the names of the templates that are extended, included or
+        imported with a constant name in the nodes, in the order they are
+        used."""
+
+        dependencies = []
+
+        for node in nodes:
+            if isinstance(node, InlineData):
+                node = node.node
+            if isinstance(node, NestedTags):
+                dependencies.extend(self.get_dependencies(node.nodes))
+            elif isinstance(node, SelfClosingJinjaTag) and \
+                    node.tag_name in self._dependency_tags:
+                m = self._template_name_re.match(node.attrs)
+                if m and m.group(2) not in dependencies:
+                    dependencies.append(m.group(2))
+            for name in self.get_dependencies(node.children):
+                if name not in dependencies:
+                    dependencies.append(name)
+
+        return dependencies
+
+
+
     def _get_haml_tree(self, source):
 
-        source_lines = self._get_source_lines(source)
+        root = Node()
+
+        # contains always atleast one element
+        block_stack = [root]
+
+        for lineno, depth, node, extends in self._iter_nodes(
+                self._get_source_lines(source)):
+
+            del block_stack[depth+1:]
+            block_stack[-1].add(node)
+
+            if not isinstance(node, EmptyLine):
+                block_stack.append(node)
+
+        return root.children
+
+
+    def _iter_nodes(self, source_lines, start_filters=True):
+        """Parses the source lines and yields a (lineno, depth, node, extends)
+        tuple for each line.
+
+        Empty lines are yielded as children of the node above them.
+        `extends` is True if the node is a jinja tag like "else" that
+        continues the jinja tag of the previous sibling. Parallel and async
+        filters are started unless `start_filters` is False.
+        """
 
         root = Node()
 
@@ -227,19 +2035,24 @@ class Hamlish(object):
         # stack for current indent level
         indent_stack = [-1]
 
+        # The first jinja tag in the chain of tags the last node on each
+        # depth belongs to.
+        chain_heads = []
+
         for lineno, line in enumerate(source_lines, 1):
 
-            if not line.strip():
-                block_stack[-1].add(EmptyLine())
+            if isinstance(line, _FilterBlock):
+                indent = line.indent
+            elif not line.strip():
+                yield lineno, len(block_stack) - 1, EmptyLine(), False
                 continue
+            else:
+                m = self._indent_re.match(line)
+                indent = m.group(1) if m else ''
 
-            indent = 0
-            m = re.match(r'^(\s+)', line)
-            if m:
-                indent = m.group(1)
-                if ' ' in indent and '\t' in indent:
-                    raise TemplateIndentationError('Mixed tabs and spaces', lineno)
-                indent = len(indent)
+            if ' ' in indent and '\t' in indent:
+                raise TemplateIndentationError('Mixed tabs and spaces', lineno)
+            indent = len(indent)
 
             if indent > indent_stack[-1]:
                 indent_stack.append(indent)
@@ -253,7 +2066,14 @@ class Hamlish(object):
                 raise TemplateIndentationError('Unindent does not match any outer indentation level', lineno)
 
 
-            node = self._parse_line(lineno, line.strip())
+            if isinstance(line, _FilterBlock):
+                node = self._create_filter_node(lineno, line.name, line.lines,
+                                                start_filters)
+            else:
+                node = self._parse_line(lineno, line.strip())
+                if self._escape_static:
+                    self._escape_node(node, any(
+                        self._opens_raw_text(n) for n in block_stack))
 
             if not block_stack[-1].can_have_children():
 
@@ -262,34 +2082,88 @@ class Hamlish(object):
                 else:
                     raise TemplateSyntaxError('Self closing tag can\'t contain child nodes', lineno)
 
-            block_stack[-1].add(node)
-            block_stack.append(node)
+            depth = len(block_stack) - 1
 
-        return root.children
+            del chain_heads[depth+1:]
+            if len(chain_heads) <= depth:
+                chain_heads.append(None)
+
+            head = chain_heads[depth]
+            extends = (isinstance(node, JinjaTag) and head is not None and
+                node.tag_name in self._extended_tags and
+                head.tag_name in self._extended_tags[node.tag_name])
+
+            if not extends:
+                chain_heads[depth] = node if isinstance(node, JinjaTag) else None
+
+            yield lineno, depth, node, extends
+
+            block_stack.append(node)
 
 
     def _get_source_lines(self, source):
 
-        if  self._use_div_shortcut:
-            source = self._div_shorcut_re.sub(r'\1%div\2', source)
+        return list(self._iter_source_lines(source.rstrip().split('\n')))
+
+
+    def _read_lines(self, source_file):
+        # Yields the same lines as source.rstrip().split('\n') would
+        # without reading the whole file into memory.
+
+        empty_lines = 0
+        previous = None
 
-        lines = []
+        for line in source_file:
+
+            line = line.rstrip('\n')
+
+            if not line.strip():
+                empty_lines += 1
+                continue
+
+            if previous is not None:
+                yield previous
+            for i in range(empty_lines):
+                yield ''
+
+            empty_lines = 0
+            previous = line
+
+        if previous is None:
+            yield ''
+        else:
+            yield previous.rstrip()
+
+
+    def _iter_source_lines(self, source_lines):
+
+        if  self._use_div_shortcut:
+            source_lines = (self._div_shorcut_re.sub(r'\1%div\2', line)
+                            for line in source_lines)
 
         # Lines that end with CONTINUED_LINE are merged with the next line
         continued_line = []
 
 
-        source_lines = self._extract_filter_blocks(source)
+        for line in self._extract_filter_blocks(source_lines):
 
-
-        for line in source_lines:
+            if isinstance(line, _FilterBlock):
+                # The filter block ends any continued line
+                if continued_line:
+                    yield ''.join(continued_line)
+                    for i in range(len(continued_line)-1):
+                        yield ''
+                    continued_line = []
+                line.finish()
+                yield line
+                continue
 
             line = line.rstrip()
 
 
             if line and line.lstrip()[0] == self.LINE_COMMENT:
                 #Add empty line for debug mode
-                lines.append('')
+                yield ''
 
             elif line and line[-1] == self.CONTINUED_LINE:
 
@@ -305,28 +2179,25 @@ class Hamlish(object):
                 #If we have a continued line we join them together and add
                 #them to the other lines
                 continued_line.append(line.strip())
-                lines.append(''.join(continued_line))
+                yield ''.join(continued_line)
 
                 #Add empty lines for debug mode
-                lines.extend(['']*(len(continued_line)-1))
+                for i in range(len(continued_line)-1):
+                    yield ''
 
                 #Reset
                 continued_line = []
             else:
-                lines.append(line)
+                yield line
 
-        return lines
 
-
-    def _extract_filter_blocks(self, source):
-
-        lines = []
+    def _extract_filter_blocks(self, source_lines):
 
         filter_block = None
         filter_start_indent = None #The indent level of the filter start tag
         filter_block_indent = None #The indent level of the first content in the block
 
-        for line in source.rstrip().split('\n'):
+        for line in source_lines:
 
             stripped_line = line.lstrip()
 
@@ -354,24 +2225,23 @@ class Hamlish(object):
                     filter_block.append(line[len(filter_block_indent):])
                     continue
                 else:
-                    lines.append('\n'.join(filter_block))
+                    yield filter_block
                     filter_block = None
                     filter_block_indent = None
 
             if not stripped_line: # Whit space only
-                lines.append(line) # We just leave the whitespace as it is and let it be handled elsewhere
+                yield line # We just leave the whitespace as it is and let it be handled elsewhere
 
             elif stripped_line.startswith(self.FILTER_START) and self._filter_is_defined(stripped_line):
                 # A known filter was found so we start a to collect the filter block
-                filter_block = [line.rstrip()]
                 filter_start_indent = line[:len(line) - len(stripped_line)]
+                filter_block = _FilterBlock(filter_start_indent,
+                                            stripped_line[1:].strip())
             else:
-                lines.append(line)
+                yield line
 
         if filter_block is not None:
-            lines.append('\n'.join(filter_block))
-
-        return lines
+            yield filter_block
 
 
 
@@ -409,8 +2279,8 @@ class Hamlish(object):
             return PreformatedText(line[1:])
         elif line.startswith(self.JINJA_VARIABLE):
             return JinjaVariable(line[1:])
-        elif line.startswith(self.FILTER_START) and self._filter_is_defined(line.split('\n')[0]):
-            return self._create_filter_node(lineno, line)
+        elif line.startswith(self.FILTER_START) and self._filter_is_defined(line):
+            return self._create_filter_node(lineno, line[1:].strip(), [])
         elif line.startswith(self.ESCAPE_LINE):
             return TextNode(line[1:])
 
@@ -422,18 +2292,25 @@ class Hamlish(object):
             return True
         return False
 
-    # The filter block data should be a single line string
-    # that contains both the start tag definion and the content
-    # of the block.
-    # ie. :testfilter\nblock content\nblock content\n
-    def _create_filter_node(self, lineno, filter_block_data):
-        data = filter_block_data.split('\n')
-        name = data[0].strip()[1:]
-        content = '\n'.join(data[1:])
-        if not content.strip():
+    def _create_filter_node(self, lineno, name, lines, start=True):
+        if not any(line.strip() for line in lines):
             raise TemplateSyntaxError('Empty filter block (%s)' % name, lineno)
 
-        return FilterNode(self._filters[name], content)
+        node = FilterNode(self._filters[name], lines, name,
+                          self._filter_cache)
+        if not start:
+            return node
+
+        # Parallel and async filters are started as soon as they are found,
+        # and the output waits for the result when it gets to the node.
+        loop = getattr(_async_state, 'loop', None)
+        if loop is not None and asyncio.iscoroutinefunction(node.filter):
+            node.schedule(loop)
+        elif self._filter_executor is not None and \
+                getattr(node.filter, 'hamlish_parallel', False):
+            node.submit(self._filter_executor)
+
+        return node
 
 
     def _has_inline_data(self, line):
@@ -478,7 +2355,7 @@ class Hamlish(object):
 
     def _parse_html(self, lineno, line):
 
-        m = re.match('^(\w+)(.*)$', line[1:])
+        m = self._tag_re.match(line[1:])
         if m is None:
             raise TemplateSyntaxError(
                     'Expected html tag, got "%s".' % line, lineno)
@@ -502,24 +2379,97 @@ class Hamlish(object):
         elif attrs and attrs[0] == '(' and attrs[-1] == ')':
             attrs = ' ' + attrs[1:-1]
 
+        if self._escape_static:
+            attrs = self._escape_attrs(lineno, attrs)
+
         if self_closing:
             return SelfClosingHTMLTag(tag, attrs)
         return HTMLTag(tag, attrs)
 
 
+    _unescaped_re = re.compile(r'&(?!#?\w+;)|<|>')
+
+    _escapes = {'&': '&amp;', '<': '&lt;', '>': '&gt;'}
+
+    def _escape(self, data):
+        # Escapes the characters that are not part of an entity
+        return self._unescaped_re.sub(lambda m: self._escapes[m.group()], data)
+
+
+    def _has_jinja_syntax(self, data):
+        return self.output.block_start_string in data or \
+            self.output.variable_start_string in data or \
+            self.output.comment_start_string in data
+
+
+    # Tags where the content is not parsed as html
+    _raw_text_tags = frozenset(['script', 'style'])
+
+    def _opens_raw_text(self, node):
+        if isinstance(node, NestedTags):
+            return any(self._opens_raw_text(n) for n in node.nodes)
+        return isinstance(node, HTMLTag) and \
+            node.tag_name.lower() in self._raw_text_tags
+
+
+    def _escape_node(self, node, raw_text):
+        # Escapes the static text in a parsed line, unless it is inside a
+        # script or style tag.
+
+        if isinstance(node, InlineData):
+            self._escape_node(node.node, raw_text)
+            if not (raw_text or self._opens_raw_text(node.node)):
+                node.data = self._escape_text(node.data)
+        elif isinstance(node, NestedTags):
+            for n in node.nodes:
+                self._escape_node(n, raw_text)
+                raw_text = raw_text or self._opens_raw_text(n)
+        elif type(node) is TextNode and not raw_text:
+            node.data = self._escape_text(node.data)
+
+
+    def _escape_text(self, data):
+        if not self._escape_static or self._has_jinja_syntax(data):
+            return data
+        return self._escape(data)
+
+
+    def _escape_attrs(self, lineno, attrs):
+        # Escapes the quoted attribute values that contain no jinja syntax.
+
+        jinja = '|'.join('%s.*?%s' % (re.escape(start), re.escape(end))
+            for start, end in [
+                (self.output.block_start_string, self.output.block_end_string),
+                (self.output.variable_start_string, self.output.variable_end_string),
+                (self.output.comment_start_string, self.output.comment_end_string)])
+
+        parts = re.split(r'''(%s|"[^"]*"|'[^']*')''' % jinja, attrs)
+
+        for i, part in enumerate(parts):
+            if i % 2 == 0:
+                if '"' in part or "'" in part:
+                    raise TemplateSyntaxError(
+                        'Unterminated attribute value in "%s"' % attrs.strip(),
+                        lineno)
+            elif part[0] in '"\'' and not self._has_jinja_syntax(part):
+                parts[i] = part[0] + self._escape(part[1:-1]) + part[-1]
+
+        return ''.join(parts)
+
+
     def _parse_shortcut_attributes(self, attrs):
         orig_attrs = attrs
         value = attrs
         extra_attrs = ''
 
         # Extract extra attrs from parentheses, otherwise, split on first space
-        m = re.match(r'^([\.#0-9A-Za-z\-]+)\((.+?)\)$', value)
+        m = self._shortcut_extra_attrs_re.match(value)
         if m:
             value, extra_attrs = m.group(1), m.group(2)
         elif ' ' in value:
             value, extra_attrs = attrs.split(' ', 1)
 
-        parts = re.split(r'([\.#])', value)
+        parts = self._shortcut_split_re.split(value)
 
         #The first part should be empty
         parts = parts[1:]
@@ -564,7 +2514,7 @@ class Hamlish(object):
 
     def _parse_jinja(self, lineno, line):
 
-        m = re.match('^(\w+)(.*)$', line[1:])
+        m = self._tag_re.match(line[1:])
         if m is None:
             raise TemplateSyntaxError(
                     'Expected jinja tag, got "%s".' % line, lineno)
@@ -602,11 +2552,13 @@ class Hamlish(object):
 
             if not isinstance(node, JinjaTag):
                 jinja_a = None
+                ext_node = None
                 continue
 
             if jinja_a is None or (
                 node.tag_name in self._extended_tags and jinja_a.tag_name not in self._extended_tags[node.tag_name]):
                 jinja_a = node
+                ext_node = None
                 continue
 
 
@@ -689,17 +2641,111 @@ class TextNode(Node):
 
 
 class FilterNode(TextNode):
-    def __init__(self, filter, data):
+    def __init__(self, filter, lines, name=None, cache=None):
         self.filter = filter
-        self._data = data
+        self.name = name
+        self.lines = lines
+        self._cache = cache
+        self._result = None
+        self._future = None
         super(TextNode, self).__init__()
 
     def has_children(self):
         return False;
 
+    @property
+    def content(self):
+        return '\n'.join(self.lines)
+
+    def submit(self, executor):
+        "Starts running the filter in the executor."
+        self._result = self._get_cached()
+        if self._result is None:
+            self._future = executor.submit(_run_filter, self.filter, self.lines)
+
+    def schedule(self, loop):
+        "Starts running a coroutine filter in the event loop."
+        self._result = self._get_cached()
+        if self._result is None:
+            self._future = asyncio.run_coroutine_threadsafe(
+                self.filter(self.content), loop)
+
+    def iter_data(self):
+        "Returns the output of the filter as an iterable of chunks."
+        if self._result is None and self._future is None and \
+                getattr(self.filter, 'hamlish_streaming', False) and \
+                not self._is_cacheable():
+            return self.filter(iter(self.lines))
+        return [self.data]
+
     @property
     def data(self):
-        return self.filter(self._data)
+        if self._result is None:
+            if self._future is not None:
+                result = self._future.result()
+            else:
+                result = self._get_cached()
+                if result is not None:
+                    self._result = result
+                    return result
+                result = _run_filter(self.filter, self.lines)
+            # Only results that were not in the cache are saved
+            if self._is_cacheable():
+                self._cache.set(self.filter, self.content, result)
+            self._result = result
+        return self._result
+
+    def _is_cacheable(self):
+        return self._cache is not None and \
+            getattr(self.filter, 'hamlish_cacheable', False)
+
+    def _get_cached(self):
+        if self._is_cacheable():
+            return self._cache.get(self.filter, self.content)
+        return None
+
+
+def _run_filter(filter, lines):
+    # A module level function so it can be used with process pools
+    if asyncio.iscoroutinefunction(filter):
+        return _run_coroutine(filter('\n'.join(lines)))
+    if getattr(filter, 'hamlish_streaming', False):
+        return ''.join(filter(iter(lines)))
+    return filter('\n'.join(lines))
+
+
+def _run_coroutine(coroutine):
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+
+    # asyncio.run can't be called in a thread with a running loop, like
+    # when a coroutine calls env.get_template(), so it is run in another
+    # thread.
+    with ThreadPoolExecutor(1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+class _FilterBlock(object):
+    """The lines of a filter block. It is passed through the line processing
+    in place of the lines, so the content is never joined into one string
+    before the filter needs it."""
+
+    def __init__(self, indent, name):
+        self.indent = indent
+        self.name = name
+        self.lines = []
+
+    def append(self, line):
+        self.lines.append(line)
+
+    def finish(self):
+        # Trailing whitespace is removed like for the rest of the source
+        while self.lines and not self.lines[-1].strip():
+            self.lines.pop()
+        if self.lines:
+            self.lines[-1] = self.lines[-1].rstrip()
 
 
 class InlineData(Node):
@@ -722,6 +2768,14 @@ class NestedTags(Node):
         #check if last node can have children
         return self.nodes[-1].can_have_children()
 
+class StaticBlock(Node):
+    "A run of nodes without jinja syntax, written in a raw block."
+
+    def __init__(self, nodes):
+        super(StaticBlock, self).__init__()
+        self.children = nodes
+
+
 class PreformatedText(TextNode):
     pass
 
@@ -759,29 +2813,72 @@ class Output(object):
                  block_start_string='{%',
                  block_end_string='%}',
                  variable_start_string='{{',
-                 variable_end_string='}}'):
+                 variable_end_string='}}',
+                 whitespace_control=False,
+                 comment_start_string='{#',
+                 comment_end_string='#}'):
         self._indent = indent_string
         self._newline = newline_string
         self.debug = debug
+        self.whitespace_control = whitespace_control
         self.buffer = []
 
         self.block_start_string = block_start_string
         self.block_end_string = block_end_string
         self.variable_start_string = variable_start_string
         self.variable_end_string = variable_end_string
+        self.comment_start_string = comment_start_string
+        self.comment_end_string = comment_end_string
 
     def reset(self):
         self.buffer = []
 
     def create(self, nodes):
 
-        self.reset()
-
-        self._create(nodes)
+        # The output is written to a copy with its own buffer, so the
+        # same Output can be used by several conversions at the same time.
+        output = self._copy()
+        output._create(nodes)
 
         if self.debug:
-            return ''.join(self.buffer)
-        return ''.join(self.buffer).strip()
+            return ''.join(output.buffer)
+        return ''.join(output.buffer).strip()
+
+    def create_stream(self, items, output_file):
+        """Writes the output for the (lineno, depth, node, extends) tuples
+        from Hamlish._iter_nodes() to `output_file` as they are read."""
+
+        output = self._copy()
+        output.buffer = _StreamBuffer(output_file, strip=not self.debug)
+        output._stream(_PeekableIterator(items), 0)
+        output.buffer.close()
+
+    def _copy(self):
+        output = copy.copy(self)
+        output.reset()
+        return output
+
+
+    def write_static_block(self, node, depth):
+        # The nodes are rendered to one string inside a raw block, so jinja
+        # takes it as it is. Surrounding whitespace is kept outside, so it
+        # is still stripped from the start and end of the output.
+
+        output = self._copy()
+        output._create(node.children, depth)
+        data = ''.join(output.buffer)
+
+        content = data.strip()
+        if not content:
+            self.write(data)
+            return
+
+        start = len(data) - len(data.lstrip())
+        self.write(data[:start])
+        self.write('%s raw %s' % (self.block_start_string, self.block_end_string))
+        self.write(content)
+        self.write('%s endraw %s' % (self.block_start_string, self.block_end_string))
+        self.write(data[start + len(content):])
 
 
     def write_self_closing_html(self, node):
@@ -795,16 +2892,29 @@ class Output(object):
 
     def write_open_jinja(self, node):
         self.write('%s %s%s %s' % (
-            self.block_start_string,
+            self._get_block_start(),
             node.tag_name,
             node.attrs,
-            self.block_end_string))
+            self._get_block_end()))
 
     def write_close_jinja(self, node):
         self.write('%s end%s %s' % (
-            self.block_start_string,
+            self._get_block_start(),
             node.tag_name,
-            self.block_end_string))
+            self._get_block_end()))
+
+    # With whitespace control jinja removes the indentation and newlines
+    # around the tags when rendering.
+
+    def _get_block_start(self):
+        if self.whitespace_control:
+            return self.block_start_string + '-'
+        return self.block_start_string
+
+    def _get_block_end(self):
+        if self.whitespace_control:
+            return '-' + self.block_end_string
+        return self.block_end_string
 
     def write_jinja_variable(self, node):
         self.write('%s %s %s' % (
@@ -818,6 +2928,9 @@ class Output(object):
     def write_indent(self, depth):
         self.write(self._indent * depth)
 
+    def write_text(self, data):
+        self.write(data)
+
     def write(self, data):
         self.buffer.append(data)
 
@@ -836,8 +2949,11 @@ class Output(object):
             self.write_jinja_variable(node)
         elif isinstance(node, PreformatedText):
             self.write(node.data)
+        elif isinstance(node, FilterNode) and not self.debug:
+            for chunk in node.iter_data():
+                self.write(chunk)
         elif isinstance(node, TextNode):
-            self.write(node.data)
+            self.write_text(node.data)
 
 
     def write_close_node(self, node):
@@ -864,12 +2980,16 @@ class Output(object):
                     self.write_newline()
                 continue
 
+            if isinstance(node, StaticBlock):
+                self.write_static_block(node, depth)
+                continue
+
 
 
             if isinstance(node, InlineData):
                 self.write_indent(depth)
                 self.write_open_node(node.node)
-                self.write(node.data)
+                self.write_text(node.data)
                 self.write_close_node(node.node)
                 self.write_newline()
 
@@ -925,3 +3045,310 @@ class Output(object):
             if self.debug:
                 #readd the whitespace after the end tag
                 self.write(''.join(prev))
+
+
+
+    # The methods below do the same as _create(), but work on the flat
+    # stream of nodes from Hamlish._iter_nodes() instead of a tree. A node
+    # is written as soon as the line after it has been read, which is
+    # enough to know if it has children or is continued by an "else".
+
+    def _stream(self, items, depth):
+
+        while True:
+
+            item = items.peek()
+            if item is None or item[1] < depth:
+                return
+
+            node = next(items)[2]
+
+            if isinstance(node, EmptyLine):
+                if self.debug:
+                    self.write_newline()
+                continue
+
+            self._stream_node(items, node, depth)
+
+
+    def _stream_node(self, items, node, depth):
+
+        empty_lines = self._skip_empty_lines(items)
+        has_children = self._has_children(items, depth)
+
+        if isinstance(node, InlineData):
+            self.write_indent(depth)
+            self.write_open_node(node.node)
+            self.write_text(node.data)
+            self.write_close_node(node.node)
+            self.write_newline()
+
+        elif isinstance(node, JinjaTag) and not has_children and \
+                self._is_continued(items, depth):
+            # Empty lines are not written for the tags in a chain
+            # that have no children.
+            self.write_indent(depth)
+            self.write_open_node(node)
+            self.write_newline()
+            self._stream_chain(items, node, depth)
+            return
+
+        else:
+            if not isinstance(node, (PreformatedText, FilterNode)):
+                self.write_indent(depth)
+            self.write_open_node(node)
+
+            if isinstance(node, SelfClosingTag):
+                self.write_newline()
+            elif isinstance(node, PreformatedText):
+                self.write('\n')
+            elif isinstance(node, (JinjaTag, HTMLTag, NestedTags)) and not has_children:
+                pass
+            else:
+                self.write_newline()
+
+        self._stream_children(items, depth, empty_lines, has_children)
+
+        if isinstance(node, JinjaTag) and self._is_continued(items, depth):
+            self._stream_chain(items, node, depth)
+        else:
+            self._stream_close(node, depth, has_children)
+
+
+    def _stream_chain(self, items, head, depth):
+
+        while self._is_continued(items, depth):
+
+            node = next(items)[2]
+
+            empty_lines = self._skip_empty_lines(items)
+            has_children = self._has_children(items, depth)
+
+            self.write_indent(depth)
+            self.write_open_node(node)
+            self.write_newline()
+            if has_children:
+                self._stream_children(items, depth, empty_lines, has_children)
+
+        self._stream_close(head, depth, True)
+
+
+    def _stream_children(self, items, depth, empty_lines, has_children):
+
+        if self.debug:
+            for i in range(empty_lines):
+                self.write_newline()
+
+        if has_children:
+            self._stream(items, depth+1)
+
+
+    def _stream_close(self, node, depth, has_children):
+
+        if self.debug:
+            prev = self.buffer.pop_whitespace()
+
+        if isinstance(node, SelfClosingTag):
+            pass
+        elif isinstance(node, (JinjaTag, HTMLTag, NestedTags)):
+
+            if not (self.debug or (isinstance(node, NestedTags) and not has_children)):
+                self.write_indent(depth)
+            self.write_close_node(node)
+
+            if not self.debug or (isinstance(node, NestedTags) and not has_children):
+                self.write_newline()
+
+        if self.debug:
+            self.write(''.join(prev))
+
+
+    def _skip_empty_lines(self, items):
+
+        count = 0
+        while True:
+            item = items.peek()
+            if item is None or not isinstance(item[2], EmptyLine):
+                return count
+            next(items)
+            count += 1
+
+    def _has_children(self, items, depth):
+        item = items.peek()
+        return item is not None and item[1] > depth
+
+    def _is_continued(self, items, depth):
+        item = items.peek()
+        return item is not None and item[1] == depth and item[3]
+
+
+
+class MinifiedOutput(Output):
+    """Output without indentation and newlines, that also removes the
+    whitespace that doesn't change how the html is displayed."""
+
+    # Tags where the whitespace in the content matters
+    _preserve_tags = frozenset(['pre', 'textarea', 'script', 'style'])
+
+    _void_tags = frozenset([
+        'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link',
+        'meta', 'param', 'source', 'track', 'wbr'
+    ])
+
+    # End tags that can be left out in valid html, wherever the element is.
+    # The end of a dt can only be left out before a dt or dd.
+    _optional_end_tags = frozenset([
+        'li', 'dd', 'option', 'optgroup', 'tr', 'td', 'th', 'body',
+        'html'
+    ])
+
+    def __init__(self,
+                 omit_closing_tags=False,
+                 block_start_string='{%',
+                 block_end_string='%}',
+                 variable_start_string='{{',
+                 variable_end_string='}}',
+                 comment_start_string='{#',
+                 comment_end_string='#}'):
+        super(MinifiedOutput, self).__init__(
+            indent_string='',
+            newline_string='',
+            block_start_string=block_start_string,
+            block_end_string=block_end_string,
+            variable_start_string=variable_start_string,
+            variable_end_string=variable_end_string,
+            comment_start_string=comment_start_string,
+            comment_end_string=comment_end_string)
+
+        self.omit_closing_tags = omit_closing_tags
+
+        # The number of open tags where whitespace is kept
+        self._preserve = 0
+
+        jinja = '|'.join('%s.*?%s' % (re.escape(start), re.escape(end))
+            for start, end in [
+                (block_start_string, block_end_string),
+                (variable_start_string, variable_end_string),
+                (comment_start_string, comment_end_string)])
+
+        self._text_re = re.compile('(%s)' % jinja, re.S)
+        self._attrs_re = re.compile(r'''(%s|"[^"]*"|'[^']*')''' % jinja, re.S)
+
+    def _collapse(self, data, regex):
+        # Replaces runs of whitespace with one space, except in the parts
+        # matched by the regex.
+        parts = regex.split(data)
+        for i in range(0, len(parts), 2):
+            parts[i] = re.sub(r'\s+', ' ', parts[i])
+        return ''.join(parts)
+
+    def _normalize_attrs(self, attrs):
+        attrs = self._collapse(attrs, self._attrs_re).strip()
+        return ' ' + attrs if attrs else ''
+
+    def write_self_closing_html(self, node):
+        attrs = self._normalize_attrs(node.attrs)
+        if node.tag_name in self._void_tags:
+            self.write('<%s%s>' % (node.tag_name, attrs))
+        else:
+            self.write('<%s%s></%s>' % (node.tag_name, attrs, node.tag_name))
+
+    def write_open_html(self, node):
+        if node.tag_name in self._preserve_tags:
+            self._preserve += 1
+        self.write('<%s%s>' % (node.tag_name, self._normalize_attrs(node.attrs)))
+
+    def write_close_html(self, node):
+        if node.tag_name in self._preserve_tags:
+            self._preserve -= 1
+        if self.omit_closing_tags and node.tag_name in self._optional_end_tags:
+            return
+        self.write('</%s>' % node.tag_name)
+
+    def write_text(self, data):
+        if not self._preserve:
+            data = self._collapse(data, self._text_re)
+        self.write(data)
+
+
+class _PeekableIterator(object):
+
+    def __init__(self, iterable):
+        self._iterator = iter(iterable)
+        self._peeked = []
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._peeked:
+            return self._peeked.pop()
+        return next(self._iterator)
+
+    next = __next__
+
+    def peek(self):
+        "returns the next item without consuming it, or None at the end."
+        if not self._peeked:
+            try:
+                self._peeked.append(next(self._iterator))
+            except StopIteration:
+                return None
+        return self._peeked[-1]
+
+
+
+class _StreamBuffer(object):
+    """Used as the buffer of an Output that writes directly to a file.
+
+    Trailing whitespace is held back until more data is written. This makes
+    it possible to strip the output like Output.create() does, and to move
+    closing tags in front of the whitespace in debug mode.
+    """
+
+    def __init__(self, output_file, strip):
+        self._file = output_file
+        self._strip = strip
+        self._started = False
+        self._whitespace = []
+
+    def append(self, data):
+
+        if self._strip:
+            if not self._started:
+                data = data.lstrip()
+                if not data:
+                    return
+                self._started = True
+
+            content = data.rstrip()
+            if not content:
+                self._whitespace.append(data)
+                return
+
+            self._flush()
+            self._file.write(content)
+            if len(content) < len(data):
+                self._whitespace.append(data[len(content):])
+
+        elif data.isspace():
+            self._whitespace.append(data)
+        else:
+            self._flush()
+            self._file.write(data)
+
+    def pop_whitespace(self):
+        "Removes and returns the whitespace written since the last data."
+        prev = self._whitespace[::-1]
+        self._whitespace = []
+        return prev
+
+    def close(self):
+        if not self._strip:
+            self._flush()
+        self._whitespace = []
+
+    def _flush(self):
+        if self._whitespace:
+            self._file.write(''.join(self._whitespace))
+            self._whitespace = []
@@ -9,7 +9,14 @@ if __name__ == '__main__':
     tests = [
         'test_debug_output', 'test_html_tags', 'test_jinja_tags',
         'test_syntax', 'test_div_shortcut', 'test_compact_output',
-        'test_haml_tags'
+        'test_haml_tags', 'test_concurrency', 'test_async', 'test_streaming', 'test_events',
+        'test_inline', 'test_dependencies',
+        'test_invalidation', 'test_flatten',
+        'test_constants', 'test_variants',
+        'test_prerender', 'test_minified_output',
+        'test_whitespace_control', 'test_escape_static',
+        'test_file_extensions', 'test_from_string',
+        'test_shared_cache', 'test_sqlite_store', 'test_warm_up'
     ]
 
     suite = unittest.TestLoader().loadTestsFromNames(tests)
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import time
+import unittest
+
+from jinja2 import Environment, DictLoader
+from hamlish_jinja import Hamlish, Output, HamlishExtension
+
+import testing_base
+
+
+def slow_filter(text):
+    time.sleep(0.2)
+    return text
+
+
+async def async_filter(text):
+    await asyncio.sleep(0.2)
+    return text.upper()
+
+
+class TestAsync(testing_base.TestCase):
+
+    def _create_env(self):
+
+        env = Environment(
+            extensions=[HamlishExtension],
+            loader=DictLoader({'page.haml': '%p\n  :slow\n    ={{ name }}\n'}),
+            enable_async=True)
+        env.hamlish_filters = {'slow': slow_filter}
+
+        return env
+
+
+    def test_get_template_async(self):
+
+        env = self._create_env()
+
+        async def main():
+            template = await env.hamlish_get_template_async('page.haml')
+            return await template.render_async(name='test')
+
+        self.assertEqual(asyncio.run(main()), '<p>=test</p>')
+
+
+    def test_without_running_loop(self):
+
+        env = self._create_env()
+
+        self.assertRaises(RuntimeError, env.hamlish_get_template_async,
+            'page.haml')
+
+
+    def test_loop_is_not_blocked(self):
+
+        env = self._create_env()
+        ticks = []
+
+        async def ticker():
+            for i in range(5):
+                ticks.append(i)
+                await asyncio.sleep(0.01)
+
+        async def main():
+            tick = asyncio.ensure_future(ticker())
+            await env.hamlish_get_template_async('page.haml')
+            done = len(ticks)
+            await tick
+            return done
+
+        self.assertEqual(asyncio.run(main()), 5)
+
+
+    def test_async_filters(self):
+
+        started = []
+
+        async def waiting_filter(text):
+            # Each filter waits for the others, so they must run concurrently
+            started.append(text)
+            for i in range(500):
+                if len(started) == 3:
+                    return text.upper()
+                await asyncio.sleep(0.01)
+            raise AssertionError('The filters were not run concurrently')
+
+        env = Environment(
+            extensions=[HamlishExtension],
+            loader=DictLoader({'page.haml': '''
+%div
+    :fetch
+        a
+    :fetch
+        b
+    %p
+    :fetch
+        c
+'''}),
+            enable_async=True)
+        env.hamlish_filters = {'fetch': waiting_filter}
+
+        async def main():
+            template = await env.hamlish_get_template_async('page.haml')
+            return await template.render_async()
+
+        self.assertEqual(asyncio.run(main()), '<div>AB<p></p>C</div>')
+
+
+    def test_async_filters_without_loop(self):
+
+        hamlish = Hamlish(Output(indent_string='', newline_string=''),
+                          filters={'fetch': async_filter})
+
+        self.assertEqual(hamlish.convert_source(':fetch\n  a'), 'A')
+
+
+    def test_async_filters_with_sync_load(self):
+
+        env = Environment(
+            extensions=[HamlishExtension],
+            loader=DictLoader({'page.haml': ':fetch\n  a\n'}))
+        env.hamlish_filters = {'fetch': async_filter}
+
+        async def main():
+            return env.get_template('page.haml').render()
+
+        self.assertEqual(asyncio.run(main()), 'A')
+
+
+
+if __name__ == '__main__':
+    unittest.main()
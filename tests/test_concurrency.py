@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+import unittest
+
+from jinja2 import Environment, DictLoader
+from hamlish_jinja import Hamlish, Output, HamlishExtension, SingleFlight
+
+import testing_base
+
+
+class TestSingleFlight(testing_base.TestCase):
+
+    def _create_env(self, calls):
+
+        def slow_filter(text):
+            calls.append(text)
+            time.sleep(0.2)
+            return text
+
+        env = Environment(
+            extensions=[HamlishExtension],
+            loader=DictLoader({'page.haml': '%p\n  :slow\n    text\n'}))
+        env.hamlish_filters = {'slow': slow_filter}
+        env.cache = None
+
+        return env
+
+    def _load_concurrently(self, env, count=8):
+
+        templates = []
+        errors = []
+
+        def load():
+            try:
+                templates.append(env.get_template('page.haml'))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=load) for i in range(count)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        return templates, errors
+
+
+    def test_concurrent_loads_convert_once(self):
+
+        calls = []
+        env = self._create_env(calls)
+
+        templates, errors = self._load_concurrently(env)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(
+            set(t.render() for t in templates), set(['<p>text</p>']))
+
+
+    def test_sequential_loads_are_not_cached(self):
+
+        calls = []
+        env = self._create_env(calls)
+
+        env.get_template('page.haml')
+        env.get_template('page.haml')
+
+        self.assertEqual(len(calls), 2)
+
+
+    def test_errors_are_shared(self):
+
+        env = Environment(
+            extensions=[HamlishExtension],
+            loader=DictLoader({'page.haml': '%p\n    %a\n  %b\n'}))
+        env.cache = None
+
+        templates, errors = self._load_concurrently(env, 4)
+
+        self.assertEqual(templates, [])
+        self.assertEqual(len(errors), 4)
+
+
+    def test_interrupted_leader(self):
+
+        class Interrupt(BaseException):
+            pass
+
+        flight = SingleFlight()
+        started = threading.Event()
+        results = []
+
+        def interrupted():
+            started.set()
+            time.sleep(0.1)
+            raise Interrupt()
+
+        def leader():
+            try:
+                flight.do('key', interrupted)
+            except Interrupt:
+                pass
+
+        def follower():
+            results.append(flight.do('key', lambda: 'result'))
+
+        threads = [threading.Thread(target=leader),
+                   threading.Thread(target=follower)]
+        threads[0].start()
+        started.wait()
+        threads[1].start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(results, ['result'])
+
+
+
+class TestSharedConverter(testing_base.TestCase):
+
+    def test_shared_instance(self):
+
+        sources = []
+        for i in range(20):
+            sources.append('''
+%%ul#list%d
+    -for item in items:
+        %%li.item%d -> =item
+    -else
+        %%li << empty
+%%p
+    |pre %d
+''' % (i, i, i))
+
+        expected = [self._h(source) for source in sources]
+
+        results = {}
+        errors = []
+
+        def convert(index):
+            try:
+                for j in range(20):
+                    for k, source in enumerate(sources):
+                        results[index, j, k] = self._h(source)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=convert, args=(i,))
+                   for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        for (i, j, k), result in results.items():
+            self.assertEqual(result, expected[k])
+
+
+if __name__ == '__main__':
+    unittest.main()
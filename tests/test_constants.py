@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from jinja2 import Environment
+from hamlish_jinja import HamlishExtension
+
+import testing_base
+
+
+class TestConstants(testing_base.TestCase):
+
+    def setUp(self):
+        self.env = Environment(extensions=[HamlishExtension])
+        self.env.hamlish_constants = {
+            'config': {'search': True, 'chat': False},
+            'brand': 'acme',
+        }
+
+    def _c(self, source):
+        return self.env.preprocess(source, 'test.haml')
+
+
+    def test_true_condition(self):
+
+        s = self._c('\n'.join([
+            '-if config.search',
+            '  %form',
+            '-else',
+            '  %p',
+        ]))
+        self.assertEqual(s, '<form></form>')
+
+
+    def test_false_condition(self):
+
+        s = self._c('\n'.join([
+            '-if config.chat',
+            '  %div',
+            '%p',
+        ]))
+        self.assertEqual(s, '<p></p>')
+
+        s = self._c('\n'.join([
+            '-if config.chat',
+            '  %div',
+            '-elif brand == "acme"',
+            '  %span',
+            '-else',
+            '  %p',
+        ]))
+        self.assertEqual(s, '<span></span>')
+
+
+    def test_colon(self):
+
+        s = self._c('\n'.join([
+            '-if config.chat:',
+            '  %div',
+            '-elif config.search:',
+            '  %span',
+            '-else:',
+            '  %p',
+        ]))
+        self.assertEqual(s, '<span></span>')
+
+
+    def test_unknown_conditions(self):
+
+        s = self._c('\n'.join([
+            '-if config.chat',
+            '  %a',
+            '-elif user',
+            '  %b',
+            '-elif brand in ["acme", "other"] and not config.chat',
+            '  %c',
+            '-elif user.admin',
+            '  %d',
+            '-else',
+            '  %e',
+        ]))
+        self.assertEqual(s,
+            '{% if user %}<b></b>{% else %}<c></c>{% endif %}')
+
+        s = self._c('\n'.join([
+            '-if user or config.search',
+            '  %a',
+            '-if user and config.chat',
+            '  %b',
+            '-if config.missing',
+            '  %c',
+            '-if brand is defined and user',
+            '  %d',
+        ]))
+        self.assertEqual(s,
+            '<a></a>{% if config.missing %}<c></c>{% endif %}'
+            '{% if brand is defined and user %}<d></d>{% endif %}')
+
+
+    def test_nested(self):
+
+        s = self._c('\n'.join([
+            '-for item in items',
+            '  -if config.search',
+            '    -if config.chat',
+            '      %b',
+            '    -else',
+            '      %i',
+            '-else',
+            '  -if not config.search',
+            '    %p',
+        ]))
+        self.assertEqual(s,
+            '{% for item in items %}<i></i>{% else %}{% endfor %}')
+
+
+    def test_shadowed_names(self):
+
+        self.env.hamlish_constants = {'FLAG': True, 'OTHER': True}
+        branch = ['  -if FLAG', '    on', '  -else', '    off']
+
+        for tag in [
+                '-for FLAG in [0]',
+                '-for x, FLAG in items',
+                '-macro m(FLAG)',
+                '-macro m(x, FLAG=False):',
+                '-call(FLAG) m()',
+                '-with FLAG = 0',
+            ]:
+            s = self._c('\n'.join([tag] + branch))
+            self.assertTrue('{% if FLAG %}' in s, tag)
+
+        # The names are only hidden in the content of the tag
+        s = self._c('\n'.join(['-for FLAG in [0]', '  %p', '-if FLAG', '  on']))
+        self.assertEqual(s, '{% for FLAG in [0] %}<p></p>{% endfor %}on')
+
+        s = self._c('\n'.join(['-for x in FLAG'] + branch))
+        self.assertEqual(s, '{% for x in FLAG %}on{% endfor %}')
+
+        for tag in [
+                '-set FLAG = False',
+                '-set x, FLAG = 1, 2',
+                '-import "m.haml" as FLAG',
+                '-from "m.haml" import FLAG',
+                '-from "m.haml" import x as FLAG',
+            ]:
+            s = self._c('\n'.join(['-if FLAG', '  on', tag, '-if OTHER', '  other']))
+            self.assertTrue('{% if FLAG %}' in s, tag)
+            self.assertTrue(s.endswith('other'), tag)
+
+
+    def test_disabled(self):
+
+        self.env.hamlish_constants = None
+        s = self._c('-if config.chat\n  %p\n')
+        self.assertEqual(s, '{% if config.chat %}<p></p>{% endif %}')
+
+
+if __name__ == '__main__':
+    unittest.main()
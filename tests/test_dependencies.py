@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from jinja2 import Environment, DictLoader
+from hamlish_jinja import HamlishExtension, HamlishTagExtension, DependencyGraph
+
+import testing_base
+
+
+class TestDependencies(testing_base.TestCase):
+
+    def test_get_dependencies(self):
+
+        tree = self.hamlish.get_haml_tree('\n'.join([
+            '-extends "base.haml"',
+            '-block content',
+            '  -include "nav.haml" with context',
+            '  -import "macros.haml" as m',
+            '  -from \'forms.haml\' import input',
+            '  -include name',
+            '  -include "nav.haml"',
+        ]))
+
+        self.assertEqual(self.hamlish.get_dependencies(tree),
+            ['base.haml', 'nav.haml', 'macros.haml', 'forms.haml'])
+
+
+    def test_recorded_on_conversion(self):
+
+        env = Environment(
+            extensions=[HamlishExtension],
+            loader=DictLoader({
+                'base.haml': '%html\n  -block body\n',
+                'layout.haml': '-extends "base.haml"\n-block body\n  -include "nav.haml"\n',
+                'page.haml': '-extends "layout.haml"\n',
+                'nav.haml': '%nav\n',
+            }))
+
+        env.get_template('page.haml').render()
+
+        graph = env.hamlish_dependencies
+        self.assertEqual(graph.dependencies('page.haml'), set(['layout.haml']))
+        self.assertEqual(graph.closure('page.haml'),
+            set(['layout.haml', 'base.haml', 'nav.haml']))
+        self.assertEqual(graph.dependents('base.haml'), set(['layout.haml']))
+        self.assertEqual(graph.dependents_closure('nav.haml'),
+            set(['layout.haml', 'page.haml']))
+        self.assertEqual(graph.templates(),
+            set(['base.haml', 'layout.haml', 'page.haml', 'nav.haml']))
+
+
+    def test_inlined_templates(self):
+
+        env = Environment(
+            extensions=[HamlishExtension],
+            loader=DictLoader({
+                'page.haml': '-include "nav.haml"\n',
+                'nav.haml': '%nav\n',
+            }))
+        env.hamlish_inline_includes = True
+
+        env.get_template('page.haml')
+
+        self.assertEqual(env.hamlish_dependencies.dependencies('page.haml'),
+            set(['nav.haml']))
+
+
+    def test_haml_tag_blocks(self):
+
+        env = Environment(
+            extensions=[HamlishTagExtension],
+            loader=DictLoader({
+                'page.html': '\n'.join([
+                    '{% haml %}',
+                    '-include "a.html"',
+                    '{% endhaml %}',
+                    '<hr>',
+                    '{% haml %}',
+                    '-include "b.html"',
+                    '{% endhaml %}',
+                ]),
+                'a.html': 'a',
+                'b.html': 'b',
+            }))
+
+        env.get_template('page.html')
+
+        self.assertEqual(env.hamlish_dependencies.dependencies('page.html'),
+            set(['a.html', 'b.html']))
+
+
+    def test_from_string_not_recorded(self):
+
+        env = Environment(extensions=[HamlishExtension],
+            loader=DictLoader({'nav.haml': '%nav\n'}))
+
+        env.hamlish_from_string('-include "nav.haml"\n')
+
+        self.assertEqual(env.hamlish_dependencies.templates(), set())
+
+
+    def test_set_replaces(self):
+
+        graph = DependencyGraph()
+        graph.set('a', ['b', 'c'])
+        graph.set('a', ['c'])
+
+        self.assertEqual(graph.dependents('b'), set())
+        self.assertEqual(graph.dependents('c'), set(['a']))
+
+        graph.remove('a')
+        self.assertFalse('a' in graph)
+        self.assertEqual(graph.dependents('c'), set())
+
+
+    def test_cycle(self):
+
+        graph = DependencyGraph()
+        graph.set('a', ['b'])
+        graph.set('b', ['a'])
+
+        self.assertEqual(graph.closure('a'), set(['b']))
+        self.assertEqual(graph.dependents_closure('a'), set(['b']))
+
+
+if __name__ == '__main__':
+    unittest.main()
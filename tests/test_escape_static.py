@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from jinja2 import Environment, TemplateSyntaxError
+from hamlish_jinja import Hamlish, Output, HamlishExtension
+
+import testing_base
+
+
+class TestEscapeStatic(testing_base.TestCase):
+
+    def setUp(self):
+        self.hamlish = Hamlish(
+            Output(indent_string='', newline_string=''), escape_static=True)
+
+
+    def test_text(self):
+
+        s = self._h('''
+%p
+    Tom & Jerry <3
+%p << a > b &amp; c &#169;
+%p << {{ a }} & b
+\\%p & q
+|<b>raw</b> & x
+''')
+        r = ''.join([
+            '<p>Tom &amp; Jerry &lt;3</p>',
+            '<p>a &gt; b &amp; c &#169;</p>',
+            '<p>{{ a }} & b</p>',
+            '%p &amp; q',
+            '<b>raw</b> & x',
+        ])
+
+        self.assertEqual(s, r)
+
+
+    def test_static_attributes(self):
+
+        s = self._h('''
+%a href="/?a=1&b=2" title='Say "hi" <now>'
+%div.a&b
+''')
+        r = ''.join([
+            '''<a href="/?a=1&amp;b=2" title='Say "hi" &lt;now&gt;'></a>''',
+            '<div class="a&amp;b"></div>',
+        ])
+
+        self.assertEqual(s, r)
+
+
+    def test_mixed_attributes(self):
+
+        s = self._h('''
+%a href="/?a={{ a }}&b" title="x & y" {{ attrs }}
+%input value="{{ v|e }}" {% if c %}data-x="1 & 2"{% endif %} checked
+%p(class="{{ cls }}" id="a<b")
+''')
+        r = ''.join([
+            '<a href="/?a={{ a }}&b" title="x &amp; y" {{ attrs }}></a>',
+            '<input value="{{ v|e }}" {% if c %}data-x="1 &amp; 2"{% endif %} checked />',
+            '<p class="{{ cls }}" id="a&lt;b"></p>',
+        ])
+
+        self.assertEqual(s, r)
+
+
+    def test_unterminated_value(self):
+
+        try:
+            self._h('%p\n%a href="/x title="y"\n')
+        except TemplateSyntaxError as e:
+            self.assertEqual(e.lineno, 2)
+        else:
+            self.fail('TemplateSyntaxError not raised')
+
+
+    def test_disabled(self):
+
+        self.hamlish = Hamlish(Output(indent_string='', newline_string=''))
+
+        s = self._h('%a href="?a&b" << Tom & Jerry')
+        self.assertEqual(s, '<a href="?a&b">Tom & Jerry</a>')
+
+
+    def test_script_and_style(self):
+
+        s = self._h('''
+%script
+    if (a < b && c) {}
+    -if x
+        a && b
+%style << a > b {}
+%div -> %script -> a < b
+%p << a < b
+''')
+        r = ''.join([
+            '<script>if (a < b && c) {}{% if x %}a && b{% endif %}</script>',
+            '<style>a > b {}</style>',
+            '<div><script>a < b</script></div>',
+            '<p>a &lt; b</p>',
+        ])
+
+        self.assertEqual(s, r)
+
+
+    def test_comment_delimiters(self):
+
+        env = Environment(extensions=[HamlishExtension],
+            comment_start_string='<#', comment_end_string='#>')
+        env.hamlish_mode = 'compact'
+        env.hamlish_escape_static = True
+
+        t = env.hamlish_from_string('%p << a <# note #> b\n%a title="<# x #>"')
+        self.assertEqual(t.render(), '<p>a  b</p><a title=""></a>')
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+import io
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from jinja2 import TemplateSyntaxError
+from hamlish_jinja import Hamlish, Output, parallel_filter
+
+import testing_base
+
+
+class TestEvents(testing_base.TestCase):
+
+    def setUp(self):
+        self.hamlish = Hamlish(
+            Output(indent_string='  ', newline_string='\n'),
+            filters={'testfilter': lambda text: text.upper()})
+
+    def _events(self, source):
+        return [tuple(e)[:3] for e in self.hamlish.iter_events(source)]
+
+
+    def test_html_tags(self):
+
+        s = self._events('''
+%div#main
+    %p.text -> %br
+    %img src="a.png"
+''')
+        r = [
+            ('start_tag', 'div', 'id="main"'),
+            ('start_tag', 'p', 'class="text"'),
+            ('start_tag', 'br', ''),
+            ('end_tag', 'br', None),
+            ('end_tag', 'p', None),
+            ('start_tag', 'img', 'src="a.png"'),
+            ('end_tag', 'img', None),
+            ('end_tag', 'div', None),
+        ]
+
+        self.assertEqual(s, r)
+
+
+    def test_jinja_tags(self):
+
+        s = self._events('''
+-extends "base.haml"
+-block content
+    -if a
+        =a
+    -elif b
+    -else
+        %p << none
+''')
+        r = [
+            ('jinja_block', 'extends', '"base.haml"'),
+            ('jinja_block', 'block', 'content'),
+            ('jinja_block', 'if', 'a'),
+            ('variable', None, 'a'),
+            ('jinja_block', 'elif', 'b'),
+            ('jinja_block', 'else', ''),
+            ('start_tag', 'p', ''),
+            ('text', None, 'none'),
+            ('end_tag', 'p', None),
+            ('end_jinja_block', 'if', None),
+            ('end_jinja_block', 'block', None),
+        ]
+
+        self.assertEqual(s, r)
+
+
+    def test_text_and_filters(self):
+
+        s = self._events('''
+%pre
+    |text
+:testfilter
+    content
+Text
+''')
+        r = [
+            ('start_tag', 'pre', ''),
+            ('text', None, 'text'),
+            ('end_tag', 'pre', None),
+            ('filter', 'testfilter', 'content'),
+            ('text', None, 'Text'),
+        ]
+
+        self.assertEqual(s, r)
+
+
+    def test_linenos(self):
+
+        events = list(self.hamlish.iter_events(io.StringIO('''\
+%div
+
+    %p
+''')))
+
+        self.assertEqual([e.lineno for e in events], [1, 3, 3, 1])
+
+
+    def test_lazy(self):
+
+        events = self.hamlish.iter_events('%p\n  %a\n %b')
+
+        self.assertEqual(next(events).name, 'p')
+        self.assertEqual(next(events).name, 'a')
+        self.assertRaises(TemplateSyntaxError, list, events)
+
+
+    def test_filters_are_not_run(self):
+
+        calls = []
+
+        @parallel_filter
+        def counting(text):
+            calls.append(text)
+            return text
+
+        executor = ThreadPoolExecutor(1)
+        hamlish = Hamlish(Output(indent_string='', newline_string=''),
+                          filters={'counting': counting},
+                          filter_executor=executor)
+
+        events = list(hamlish.iter_events(':counting\n  a'))
+        executor.shutdown()
+
+        self.assertEqual([tuple(e)[:3] for e in events],
+            [('filter', 'counting', 'a')])
+        self.assertEqual(calls, [])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from jinja2 import Environment
+from hamlish_jinja import HamlishExtension, HamlishTagExtension
+
+import testing_base
+
+
+class TestFileExtensions(testing_base.TestCase):
+
+    def setUp(self):
+        self.env = Environment(extensions=[HamlishExtension])
+
+    def _is_converted(self, name):
+        return self.env.preprocess('%p', name) == '<p></p>'
+
+
+    def test_default(self):
+
+        self.assertTrue(self._is_converted('page.haml'))
+        self.assertTrue(self._is_converted('dir/page.haml'))
+        self.assertFalse(self._is_converted('page.html'))
+        self.assertFalse(self._is_converted('page.HAML'))
+        self.assertFalse(self.env.preprocess('%p', None) == '<p></p>')
+
+
+    def test_changed_extensions(self):
+
+        self.assertTrue(self._is_converted('page.haml'))
+
+        self.env.hamlish_file_extensions = ('.hamlish', '.haml.html')
+        self.assertFalse(self._is_converted('page.haml'))
+        self.assertTrue(self._is_converted('page.hamlish'))
+        self.assertTrue(self._is_converted('page.haml.html'))
+
+
+    def test_globs(self):
+
+        self.env.hamlish_file_extensions = ('*.haml.html', 'haml/*')
+
+        self.assertTrue(self._is_converted('page.haml.html'))
+        self.assertTrue(self._is_converted('haml/page.html'))
+        self.assertFalse(self._is_converted('html/page.html'))
+
+        t = self.env.hamlish_from_string('%p')
+        self.assertEqual(t.render(), '<p></p>')
+
+
+    def test_case_insensitive(self):
+
+        self.env.hamlish_case_sensitive_extensions = False
+        self.env.hamlish_file_extensions = ('.haml', '*.Haml.html')
+
+        self.assertTrue(self._is_converted('page.HAML'))
+        self.assertTrue(self._is_converted('page.haml.HTML'))
+
+
+    def test_tag_extension_without_haml(self):
+
+        env = Environment(extensions=[HamlishTagExtension])
+
+        source = '<p>{{ x }}</p>{% if a %}{% endif %}'
+        self.assertTrue(env.preprocess(source, 'page.html') is source)
+
+
+if __name__ == '__main__':
+    unittest.main()
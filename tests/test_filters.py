@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
 
+import io
+import threading
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 
 from jinja2 import Environment, TemplateSyntaxError
-from hamlish_jinja import Hamlish, Output, TemplateIndentationError, HamlishTagExtension
+from hamlish_jinja import Hamlish, Output, TemplateIndentationError, HamlishTagExtension, \
+    FilterCache, cacheable_filter, parallel_filter, streaming_filter
 
 import testing_base
 
@@ -517,5 +521,211 @@ Test
 
 
 
+calls = []
+
+@cacheable_filter
+def counting_filter(text):
+    calls.append(text)
+    return text.upper()
+
+
+class TestFilterCache(testing_base.TestCase):
+
+    def setUp(self):
+        del calls[:]
+        self.cache = FilterCache(size=2, store={})
+        self.hamlish = Hamlish(
+            Output(indent_string='', newline_string=''),
+            filters={'upper': counting_filter, 'plain': simple_filter},
+            filter_cache=self.cache)
+
+    def test_results_are_cached(self):
+
+        self.assertEqual(self._h(':upper\n  test'), 'TEST')
+        self.assertEqual(self._h('%p\n  :upper\n    test'), '<p>TEST</p>')
+        self.assertEqual(calls, ['test'])
+
+    def test_not_cacheable(self):
+
+        plain_calls = []
+
+        def plain(text):
+            plain_calls.append(text)
+            return text
+
+        cache = FilterCache()
+        self.assertEqual(cache.apply(plain, 'a'), 'a')
+        self.assertEqual(cache.apply(plain, 'a'), 'a')
+        self.assertEqual(plain_calls, ['a', 'a'])
+
+    def test_eviction(self):
+
+        for text in ['a', 'b', 'c', 'a']:
+            self.cache.apply(counting_filter, text)
+
+        self.cache.store.clear()
+        self.cache.apply(counting_filter, 'a')
+        self.cache.apply(counting_filter, 'b')
+
+        self.assertEqual(calls, ['a', 'b', 'c', 'b'])
+
+    def test_store(self):
+
+        self._h(':upper\n  test')
+        self.assertEqual(list(self.cache.store.values()), ['TEST'])
+
+        self.cache.clear()
+        self.assertEqual(self._h(':upper\n  test'), 'TEST')
+        self.assertEqual(calls, ['test'])
+
+    def test_hits_are_not_written(self):
+
+        writes = []
+
+        class Store(dict):
+            def __setitem__(self, key, value):
+                writes.append(key)
+                dict.__setitem__(self, key, value)
+
+        self.cache.store = Store()
+        for i in range(5):
+            self.assertEqual(self._h(':upper\n  test'), 'TEST')
+
+        self.assertEqual(len(writes), 1)
+
+    def test_lambdas_are_not_stored(self):
+
+        self.cache.apply(cacheable_filter(lambda text: text), 'test')
+        self.assertEqual(self.cache.store, {})
+
+
+class TestParallelFilters(testing_base.TestCase):
+
+    def setUp(self):
+        self.executor = ThreadPoolExecutor(4)
+
+        # Each filter waits for the others, so they must run in parallel
+        barrier = threading.Barrier(4, timeout=5)
+
+        @parallel_filter
+        def waiting_filter(text):
+            barrier.wait()
+            return text.upper()
+
+        self.hamlish = Hamlish(
+            Output(indent_string='', newline_string=''),
+            filters={'wait': waiting_filter, 'plain': simple_filter},
+            filter_executor=self.executor)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_parallel(self):
+
+        source = '%div\n' + ''.join(
+            '  :wait\n    text%d\n  :plain\n    plain%d\n' % (i, i)
+            for i in range(4))
+
+        s = self._h(source)
+
+        r = '<div>' + ''.join(
+            'TEXT%dplain%d' % (i, i) for i in range(4)) + '</div>'
+
+        self.assertEqual(s, r)
+
+    def test_errors(self):
+
+        @parallel_filter
+        def failing_filter(text):
+            raise ValueError(text)
+
+        hamlish = Hamlish(Output(), filters={'fail': failing_filter},
+                          filter_executor=self.executor)
+
+        self.assertRaises(ValueError, hamlish.convert_source, ':fail\n  test')
+
+
+class TestStreamingFilters(testing_base.TestCase):
+
+    def setUp(self):
+        self.received = []
+
+        @streaming_filter
+        def json_filter(lines):
+            self.received.append(lines)
+            yield '<script type="application/json">'
+            for line in lines:
+                yield line.strip()
+            yield '</script>'
+
+        @cacheable_filter
+        @streaming_filter
+        def cached_filter(lines):
+            return json_filter(lines)
+
+        self.hamlish = Hamlish(
+            Output(indent_string='', newline_string=''),
+            filters={'json': json_filter, 'cached': cached_filter},
+            filter_cache=FilterCache())
+
+    def test_streaming_filter(self):
+
+        source = '''
+%div
+    :json
+        {
+            "a": 1
+        }
+
+    %p
+'''
+        r = '''<div><script type="application/json">{"a": 1}</script><p></p></div>'''
+
+        self.assertEqual(self._h(source), r)
+        self.assertFalse(isinstance(self.received[0], (list, str)))
+
+        output = io.StringIO()
+        self.hamlish.convert_file(io.StringIO(source), output)
+        self.assertEqual(output.getvalue(), r)
+
+    def test_chunks_are_written_as_they_are_made(self):
+
+        output = io.StringIO()
+        written = []
+
+        @streaming_filter
+        def chunks(lines):
+            for line in lines:
+                yield line.strip()
+                written.append(output.getvalue())
+
+        hamlish = Hamlish(Output(indent_string='', newline_string=''),
+                          filters={'chunks': chunks})
+        hamlish.convert_file(io.StringIO('%p\n  :chunks\n    a\n    b\n'), output)
+
+        self.assertEqual(written, ['<p>a', '<p>ab'])
+        self.assertEqual(output.getvalue(), '<p>ab</p>')
+
+    def test_cached_streaming_filter(self):
+
+        source = ':cached\n  [1, 2]\n'
+        r = '''<script type="application/json">[1, 2]</script>'''
+
+        self.assertEqual(self._h(source), r)
+        self.assertEqual(self._h(source), r)
+        self.assertEqual(len(self.received), 1)
+
+    def test_continued_line_in_block(self):
+
+        s = self._h('''
+:json
+    [1, \\
+%p
+''')
+        r = '''<script type="application/json">[1, \\</script><p></p>'''
+
+        self.assertEqual(s, r)
+
+
 if __name__ == '__main__':
     unittest.main()
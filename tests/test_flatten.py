@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from jinja2 import Environment, DictLoader
+from hamlish_jinja import HamlishExtension, HamlishLoader
+
+import testing_base
+
+
+TEMPLATES = {
+    'base.haml': '\n'.join([
+        '%html',
+        '  %head',
+        '    -block head',
+        '      %title << Site',
+        '  %body',
+        '    -block body',
+        '      -block content',
+        '    -block footer',
+        '      %p << footer',
+    ]),
+    'layout.haml': '\n'.join([
+        '-extends "base.haml"',
+        '-block head',
+        '  = super()',
+        '  %link href="/style.css"',
+        '-block content',
+        '  %main',
+        '    -block main',
+        '      %p << default',
+    ]),
+    'page.haml': '\n'.join([
+        '-extends "layout.haml"',
+        '',
+        '-block main',
+        '  %h1 << {{ title }}',
+        '-block footer',
+        '  %div',
+        '    = super()',
+    ]),
+}
+
+
+class TestFlatten(testing_base.TestCase):
+
+    def _create_env(self, templates, flatten):
+
+        env = Environment(
+            extensions=[HamlishExtension],
+            loader=HamlishLoader(DictLoader(templates)),
+            auto_reload=True)
+        env.hamlish_flatten_templates = flatten
+
+        return env
+
+
+    def _source(self, env, name):
+        source = env.loader.get_source(env, name)[0]
+        return env.preprocess(source, name)
+
+
+    def test_same_output(self):
+
+        normal = self._create_env(TEMPLATES, ())
+        flat = self._create_env(TEMPLATES, set(['page.haml']))
+
+        self.assertEqual(
+            flat.get_template('page.haml').render(title='Hi'),
+            normal.get_template('page.haml').render(title='Hi'))
+
+        source = self._source(flat, 'page.haml')
+        self.assertFalse('extends' in source)
+        self.assertFalse('super' in source)
+        self.assertEqual(flat.hamlish_dependencies.dependencies('page.haml'),
+            set(['layout.haml', 'base.haml']))
+
+
+    def test_reload_parent(self):
+
+        templates = dict(TEMPLATES)
+        env = self._create_env(templates, set(['page.haml']))
+
+        env.get_template('page.haml').render(title='Hi')
+        templates['base.haml'] = '\n'.join([
+            '%body',
+            '  -block content',
+            '  -block footer',
+            '    %p << new',
+        ])
+
+        self.assertEqual(env.get_template('page.haml').render(title='Hi'),
+            '<body><main><h1>Hi</h1></main><div><p>new</p></div></body>')
+
+
+    def test_not_flattened(self):
+
+        for page in [
+                '-extends layout\n-block main\n',
+                '-extends "missing.haml"\n-block main\n',
+                '-extends "layout.haml"\n%p\n',
+                '-extends "layout.haml"\n-block main\n  = super() + "x"\n',
+                '-extends "layout.haml"\n-block main\n  %p << {{ super() }}\n',
+                '-extends "layout.haml"\n-block main\n  -block footer\n',
+                '-extends "layout.haml"\n-block content\n  = super()\n  %p\n',
+                '-extends "layout.haml"\n-block main\n-block missing\n',
+                '-extends "layout.haml"\n-block main\n  -block (x)\n',
+            ]:
+            templates = dict(TEMPLATES, **{'page.haml': page})
+            env = self._create_env(templates, set(['page.haml']))
+
+            self.assertTrue('{% extends' in self._source(env, 'page.haml'), page)
+
+
+    def test_block_modifiers(self):
+
+        for base in [
+                '%div\n  -block content:\n    %p << base\n',
+                '%div\n  -block content scoped\n    %p << base\n',
+                '%div\n  -block content required\n',
+            ]:
+            templates = {
+                'base.haml': base,
+                'page.haml': '-extends "base.haml"\n-block content:\n  %p << child\n',
+            }
+            env = self._create_env(templates, set(['page.haml']))
+
+            self.assertFalse('{% extends' in self._source(env, 'page.haml'), base)
+            self.assertEqual(env.get_template('page.haml').render(),
+                '<div><p>child</p></div>')
+
+
+    def test_unparsed_parent_block(self):
+
+        templates = {
+            'base.haml': '%div\n  -block content if x\n    %p << base\n',
+            'page.haml': '-extends "base.haml"\n-block content\n  %p << child\n',
+        }
+        env = self._create_env(templates, set(['page.haml']))
+
+        self.assertTrue('{% extends' in self._source(env, 'page.haml'))
+
+
+if __name__ == '__main__':
+    unittest.main()
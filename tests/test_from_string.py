@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, \
+    ProcessPoolExecutor
+
+from jinja2 import Environment, DictLoader, TemplateSyntaxError
+from hamlish_jinja import HamlishExtension, CodeCache
+
+import testing_base
+
+
+class TestFromStringCache(testing_base.TestCase):
+
+    def setUp(self):
+        self.env = Environment(extensions=[HamlishExtension])
+
+        self.compiled = []
+        compile = self.env.compile
+        def counting_compile(source, name=None, *args):
+            self.compiled.append(source)
+            return compile(source, name, *args)
+        self.env.compile = counting_compile
+
+
+    def test_cached(self):
+
+        for i in range(3):
+            t = self.env.hamlish_from_string('%p << {{ x }}')
+            self.assertEqual(t.render(x=i), '<p>%d</p>' % i)
+
+        self.assertEqual(len(self.compiled), 1)
+        self.assertEqual(self.env.hamlish_from_string_cache.stats(),
+            {'hits': 2, 'misses': 1, 'evictions': 0, 'size': 1})
+
+
+    def test_globals(self):
+
+        a = self.env.hamlish_from_string('%p << {{ x }}', globals={'x': 'a'})
+        b = self.env.hamlish_from_string('%p << {{ x }}', globals={'x': 'b'})
+
+        self.assertEqual(a.render(), '<p>a</p>')
+        self.assertEqual(b.render(), '<p>b</p>')
+        self.assertEqual(len(self.compiled), 1)
+
+
+    def test_config_change(self):
+
+        self.env.hamlish_from_string('%p\n  text')
+        self.env.hamlish_mode = 'indented'
+        t = self.env.hamlish_from_string('%p\n  text')
+
+        self.assertEqual(t.render(), '<p>\n    text\n</p>')
+        self.assertEqual(len(self.compiled), 2)
+
+
+    def test_eviction(self):
+
+        self.env.hamlish_from_string_cache = CodeCache(size=2)
+
+        for source in ['%a', '%b', '%c', '%a']:
+            self.env.hamlish_from_string(source)
+
+        stats = self.env.hamlish_from_string_cache.stats()
+        self.assertEqual(stats['misses'], 4)
+        self.assertEqual(stats['evictions'], 2)
+        self.assertEqual(stats['size'], 2)
+
+
+    def test_disabled(self):
+
+        self.env.hamlish_from_string_cache = None
+
+        self.env.hamlish_from_string('%p')
+        self.env.hamlish_from_string('%p')
+
+        self.assertEqual(len(self.compiled), 2)
+
+
+    def test_changed_inlined_template(self):
+
+        templates = {'p.haml': '%p << one\n'}
+        self.env.loader = DictLoader(templates)
+        self.env.hamlish_inline_includes = True
+
+        t = self.env.hamlish_from_string('-include "p.haml"\n')
+        self.assertEqual(t.render(), '<p>one</p>')
+        self.env.hamlish_from_string('-include "p.haml"\n')
+        self.assertEqual(len(self.compiled), 1)
+
+        templates['p.haml'] = '%p << two\n'
+        t = self.env.hamlish_from_string('-include "p.haml"\n')
+        self.assertEqual(t.render(), '<p>two</p>')
+
+
+
+class TestFromStringBatch(testing_base.TestCase):
+
+    def setUp(self):
+        self.env = Environment(extensions=[HamlishExtension])
+        self.env.hamlish_from_string_cache = None
+
+
+    def test_batch(self):
+
+        sources = ['%p << {{ x }}', '%a', '%p << {{ x }}', '%b']
+        templates = self.env.hamlish_from_string_batch(sources)
+
+        self.assertEqual([t.render(x=1) for t in templates],
+            ['<p>1</p>', '<a></a>', '<p>1</p>', '<b></b>'])
+        self.assertTrue(templates[0] is templates[2])
+
+
+    def test_errors(self):
+
+        templates = self.env.hamlish_from_string_batch(
+            ['%p', '%p\n    %a\n  %b', '%i << {{ x', '%b'],
+            globals={'x': 1})
+
+        self.assertEqual(templates[0].render(), '<p></p>')
+        self.assertTrue(isinstance(templates[1], TemplateSyntaxError))
+        self.assertTrue(isinstance(templates[2], TemplateSyntaxError))
+        self.assertEqual(templates[3].render(), '<b></b>')
+
+
+    def test_executor(self):
+
+        executor = ThreadPoolExecutor(2)
+        templates = self.env.hamlish_from_string_batch(
+            ['%a', '%b'], executor=executor)
+        executor.shutdown()
+
+        self.assertEqual([t.render() for t in templates], ['<a></a>', '<b></b>'])
+
+
+    def test_other_executor(self):
+
+        class InlineExecutor(Executor):
+            def submit(self, fn, *args):
+                future = Future()
+                future.set_result(fn(*args))
+                return future
+
+        templates = self.env.hamlish_from_string_batch(
+            ['%a'], executor=InlineExecutor())
+
+        self.assertEqual(templates[0].render(), '<a></a>')
+
+
+
+    def test_process_pool(self):
+
+        executor = ProcessPoolExecutor(1)
+        try:
+            self.assertRaises(TypeError, self.env.hamlish_from_string_batch,
+                ['%a'], executor=executor)
+
+            self.env.hamlish_executor = executor
+            self.assertRaises(TypeError, self.env.hamlish_from_string_batch,
+                ['%a'])
+        finally:
+            executor.shutdown()
+
+
+
+if __name__ == '__main__':
+    unittest.main()
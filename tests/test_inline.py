@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from jinja2 import Environment, DictLoader
+from hamlish_jinja import HamlishExtension, HamlishLoader
+
+import testing_base
+
+
+class TestInlineIncludes(testing_base.TestCase):
+
+    def _create_env(self, templates, auto_reload=False):
+
+        env = Environment(
+            extensions=[HamlishExtension],
+            loader=HamlishLoader(DictLoader(templates)),
+            auto_reload=auto_reload)
+        env.hamlish_inline_includes = True
+
+        return env
+
+
+    def _source(self, env, name):
+        source = env.loader.get_source(env, name)[0]
+        return env.preprocess(source, name)
+
+
+    def test_inline_include(self):
+
+        env = self._create_env({
+            'page.haml': '%div\n  -include "nav.haml"\n',
+            'nav.haml': '%nav\n  %a href="/" << Home\n',
+        })
+
+        self.assertEqual(self._source(env, 'page.haml'),
+            '<div><nav><a href="/">Home</a></nav></div>')
+        self.assertEqual(env.get_template('page.haml').render(),
+            '<div><nav><a href="/">Home</a></nav></div>')
+
+
+    def test_nested_include(self):
+
+        env = self._create_env({
+            'page.haml': '-include "a.haml"\n',
+            'a.haml': '%a\n  -include \'b.haml\' with context\n',
+            'b.haml': '%b << {{ name }}\n',
+        })
+
+        self.assertEqual(env.get_template('page.haml').render(name='x'),
+            '<a><b>x</b></a>')
+
+
+    def test_not_inlined(self):
+
+        env = self._create_env({
+            'page.haml': '\n'.join([
+                '-include name',
+                '-include "missing.haml" ignore missing',
+                '-include "other.html"',
+                '-include "block.haml"',
+                '-include "missing.haml"',
+                '-include "page.haml"',
+            ]),
+            'other.html': '<p></p>',
+            'block.haml': '-block content\n',
+        })
+
+        self.assertEqual(self._source(env, 'page.haml'), ''.join([
+            '{% include name %}',
+            '{% include "missing.haml" ignore missing %}',
+            '{% include "other.html" %}',
+            '{% include "block.haml" %}',
+            '{% include "missing.haml" %}',
+            '{% include "page.haml" %}',
+        ]))
+
+
+    def test_disabled(self):
+
+        env = self._create_env({
+            'page.haml': '-include "nav.haml"\n',
+            'nav.haml': '%nav\n',
+        })
+        env.hamlish_inline_includes = False
+
+        self.assertEqual(self._source(env, 'page.haml'),
+            '{% include "nav.haml" %}')
+
+
+    def test_reload_on_change(self):
+
+        templates = {
+            'page.haml': '%div\n  -include "nav.haml"\n',
+            'nav.haml': '%nav\n',
+        }
+        env = self._create_env(templates, auto_reload=True)
+
+        self.assertEqual(env.get_template('page.haml').render(),
+            '<div><nav></nav></div>')
+
+        templates['nav.haml'] = '%ul\n'
+
+        self.assertEqual(env.get_template('page.haml').render(),
+            '<div><ul></ul></div>')
+
+
+if __name__ == '__main__':
+    unittest.main()
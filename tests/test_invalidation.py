@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from jinja2 import Environment, DictLoader
+from hamlish_jinja import HamlishExtension, HamlishLoader, ConversionCache
+
+import testing_base
+
+
+class TestInvalidation(testing_base.TestCase):
+
+    def _create_env(self, templates, auto_reload=False):
+
+        env = Environment(
+            extensions=[HamlishExtension],
+            loader=HamlishLoader(DictLoader(templates)),
+            auto_reload=auto_reload)
+        env.hamlish_conversion_cache = ConversionCache()
+
+        self.conversions = []
+        def count(text):
+            self.conversions.append(text)
+            return text
+        env.hamlish_filters = {'count': count}
+
+        return env
+
+
+    def test_conversion_cache(self):
+
+        env = self._create_env({'page.haml': '%p\n  :count\n    page\n'})
+
+        env.get_template('page.haml')
+        env.cache.clear()
+        self.assertEqual(env.get_template('page.haml').render(), '<p>page</p>')
+
+        self.assertEqual(self.conversions, ['page'])
+
+
+    def test_config_change(self):
+
+        env = self._create_env({'page.haml': '%p\n  :count\n    page\n'})
+
+        env.get_template('page.haml')
+        env.cache.clear()
+        env.hamlish_mode = 'indented'
+        self.assertEqual(env.get_template('page.haml').render(),
+            '<p>\npage\n</p>')
+
+        self.assertEqual(self.conversions, ['page', 'page'])
+
+
+    def test_invalidate(self):
+
+        env = self._create_env({
+            'base.haml': '%html\n  -block body\n',
+            'page.haml': '-extends "base.haml"\n',
+            'other.haml': '%p\n',
+            'user.haml': '-extends "page.haml"\n',
+        })
+
+        for name in ['user.haml', 'other.haml']:
+            env.get_template(name).render()
+
+        self.assertEqual(env.hamlish_invalidate('base.haml'),
+            set(['base.haml', 'page.haml', 'user.haml']))
+
+        cached = set(key[1] for key in env.cache.keys())
+        self.assertEqual(cached, set(['other.haml']))
+
+
+    def test_auto_reload_inlined(self):
+
+        templates = {
+            'page.haml': '%div\n  -include "nav.haml"\n',
+            'nav.haml': '%nav\n',
+            'other.haml': '%p\n',
+        }
+        env = self._create_env(templates, auto_reload=True)
+        env.hamlish_inline_includes = True
+
+        env.get_template('page.haml')
+        env.get_template('other.haml')
+
+        templates['nav.haml'] = '%ul\n'
+
+        self.assertEqual(env.get_template('page.haml').render(),
+            '<div><ul></ul></div>')
+        self.assertEqual(env.cache.get(next(
+            key for key in env.cache.keys() if key[1] == 'other.haml')).render(),
+            '<p></p>')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -192,6 +192,34 @@ class TestJinjaTags(testing_base.TestCase):
 
         self.assertEqual(s, r)
 
+    def test_separated_if_else(self):
+        s = self._h('''
+-if a
+    Test
+-else
+    Test
+%p
+-if b
+    Test
+-else
+    Test
+''')
+        r = '''\
+{% if a %}
+  Test
+{% else %}
+  Test
+{% endif %}
+<p></p>
+{% if b %}
+  Test
+{% else %}
+  Test
+{% endif %}\
+'''
+
+        self.assertEqual(s, r)
+
 
 
 
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from jinja2 import Environment
+from hamlish_jinja import Hamlish, MinifiedOutput, HamlishExtension
+
+import testing_base
+
+
+class TestMinifiedOutput(testing_base.TestCase):
+
+
+    def setUp(self):
+        self.hamlish = Hamlish(MinifiedOutput())
+
+
+    def test_text(self):
+
+        s = self._h('''
+%p
+    Some    text  {{ "a   b" }}   here
+%p << inline    text {#   x   #}
+''')
+        r = '<p>Some text {{ "a   b" }} here</p><p>inline text {#   x   #}</p>'
+
+        self.assertEqual(s, r)
+
+
+    def test_preserved_tags(self):
+
+        s = self._h('''
+%pre
+    |a    b
+    %span << c    d
+%script
+    var  a;
+%p << e    f
+''')
+        r = '<pre>a    b\n<span>c    d</span></pre><script>var  a;</script><p>e f</p>'
+
+        self.assertEqual(s, r)
+
+
+    def test_attrs(self):
+
+        s = self._h('''
+%a    href="/a  b"   class='x  y'   title="{{ t }}"
+%div  {{ attrs  }}   id="x"
+%p.
+''')
+        r = '''<a href="/a  b" class='x  y' title="{{ t }}"></a><div {{ attrs  }} id="x"></div><p></p>'''
+
+        self.assertEqual(s, r)
+
+
+    def test_void_tags(self):
+
+        s = self._h('''
+%br
+%img src="a.png"
+%input.
+''')
+        r = '<br><img src="a.png"><input>'
+
+        self.assertEqual(s, r)
+
+
+    def test_omit_closing_tags(self):
+
+        self.hamlish = Hamlish(MinifiedOutput(omit_closing_tags=True))
+
+        s = self._h('''
+%ul
+    %li << a
+    %li << b
+%p << c
+%dl
+    %dt << d
+    %dd << e
+''')
+        r = '<ul><li>a<li>b</ul><p>c</p><dl><dt>d</dt><dd>e</dl>'
+
+        self.assertEqual(s, r)
+
+
+    def test_mode(self):
+
+        env = Environment(extensions=[HamlishExtension])
+        env.hamlish_mode = 'minified'
+        env.hamlish_minify_omit_closing_tags = True
+
+        s = env.preprocess('%ul\n  %li << a   b\n%br\n', 'test.haml')
+        self.assertEqual(s, '<ul><li>a b</ul><br>')
+
+
+if __name__ == '__main__':
+    unittest.main()
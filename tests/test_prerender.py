@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from jinja2 import Environment
+from hamlish_jinja import HamlishExtension
+
+import testing_base
+
+
+class TestPrerenderStatic(testing_base.TestCase):
+
+    def setUp(self):
+        self.env = Environment(extensions=[HamlishExtension])
+        self.env.hamlish_prerender_static = True
+
+    def _c(self, source):
+        return self.env.preprocess(source, 'test.haml')
+
+
+    def test_static_runs(self):
+
+        s = self._c('\n'.join([
+            '%nav',
+            '  %a href="/" << Home',
+            '%div',
+            '  %p << {{ text }}',
+            '  %hr',
+            '  %p',
+            '    Static',
+            '-if user',
+            '  %footer',
+        ]))
+
+        self.assertEqual(s, ''.join([
+            '{% raw %}<nav><a href="/">Home</a></nav>{% endraw %}',
+            '<div><p>{{ text }}</p>',
+            '{% raw %}<hr /><p>Static</p>{% endraw %}',
+            '</div>',
+            '{% if user %}{% raw %}<footer></footer>{% endraw %}{% endif %}',
+        ]))
+
+
+    def test_jinja_syntax(self):
+
+        s = self._c('\n'.join([
+            '%p class="{{ cls }}"',
+            '%p << {# comment #}',
+            '= var',
+            '%div',
+            '  {% if a %}x{% endif %}',
+        ]))
+
+        self.assertFalse('raw' in s)
+
+
+    def test_indented(self):
+
+        self.env.hamlish_mode = 'indented'
+
+        source = '%div\n  %p\n    text\n  =var\n'
+        s = self._c(source)
+
+        self.assertEqual(s, '\n'.join([
+            '<div>',
+            '    {% raw %}<p>',
+            '        text',
+            '    </p>{% endraw %}',
+            '    {{ var }}',
+            '</div>',
+        ]))
+
+        self.env.hamlish_prerender_static = False
+        self.assertEqual(self.env.from_string(s).render(var='v'),
+            self.env.from_string(self._c(source)).render(var='v'))
+
+
+    def test_disabled_by_options(self):
+
+        for option in ['trim_blocks', 'lstrip_blocks']:
+            env = Environment(extensions=[HamlishExtension], **{option: True})
+            env.hamlish_prerender_static = True
+            self.assertEqual(env.preprocess('%p', 'test.haml'), '<p></p>')
+
+        env = Environment(extensions=[HamlishExtension],
+            line_statement_prefix='#')
+        env.hamlish_prerender_static = True
+        self.assertEqual(env.preprocess('%p', 'test.haml'), '<p></p>')
+
+
+if __name__ == '__main__':
+    unittest.main()
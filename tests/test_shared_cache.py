@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from jinja2 import Environment, DictLoader
+from hamlish_jinja import HamlishExtension, ConversionCache
+
+import testing_base
+
+
+class TestSharedCache(testing_base.TestCase):
+
+    def setUp(self):
+
+        self.loader = DictLoader({'page.haml': '%p\n  :count\n    {{ name }}\n'})
+
+        self.conversions = []
+        def count(text):
+            self.conversions.append(text)
+            return text
+        self.filters = {'count': count}
+
+        self.cache = ConversionCache()
+
+
+    def _create_env(self, **options):
+
+        env = Environment(extensions=[HamlishExtension], loader=self.loader,
+            **options)
+        env.hamlish_filters = self.filters
+        env.hamlish_conversion_cache = self.cache
+
+        return env
+
+
+    def test_overlays(self):
+
+        env = self._create_env()
+
+        for tenant in ['a', 'b', 'c']:
+            overlay = env.overlay(cache_size=0)
+            overlay.globals = dict(env.globals, name=tenant)
+            t = overlay.get_template('page.haml')
+            self.assertEqual(t.render(), '<p>%s</p>' % tenant)
+
+        self.assertEqual(len(self.conversions), 1)
+
+
+    def test_sibling_environments(self):
+
+        self._create_env().get_template('page.haml')
+        self._create_env().get_template('page.haml')
+
+        self.assertEqual(len(self.conversions), 1)
+
+        env = self._create_env()
+        env.hamlish_mode = 'indented'
+        env.get_template('page.haml')
+
+        env = self._create_env(variable_start_string='[[',
+                               variable_end_string=']]')
+        env.get_template('page.haml')
+
+        self.assertEqual(len(self.conversions), 3)
+
+        self.cache.invalidate('page.haml')
+        self._create_env().get_template('page.haml')
+        self.assertEqual(len(self.conversions), 4)
+
+
+    def test_dependencies_from_cache(self):
+
+        self.loader.mapping['page.haml'] = '-extends "base.haml"\n'
+        self.loader.mapping['base.haml'] = '%p\n'
+
+        self._create_env().get_template('page.haml')
+        env = self._create_env()
+        env.get_template('page.haml')
+
+        self.assertEqual(env.hamlish_dependencies.dependencies('page.haml'),
+            set(['base.haml']))
+
+
+    def test_flattened_in_one_environment(self):
+
+        self.loader.mapping['page.haml'] = \
+            '-extends "base.haml"\n-block body\n  %p child\n'
+        self.loader.mapping['base.haml'] = '%div\n  -block body\n'
+
+        flat = self._create_env()
+        flat.hamlish_inline_includes = True
+        flat.hamlish_flatten_templates = set(['page.haml'])
+        env = self._create_env()
+        env.hamlish_inline_includes = True
+
+        source = self.loader.mapping['page.haml']
+        self.assertFalse('extends' in flat.preprocess(source, 'page.haml'))
+        self.assertTrue('extends' in env.preprocess(source, 'page.haml'))
+
+
+    def test_file_extensions_of_inlined_templates(self):
+
+        self.loader.mapping['page.haml'] = '-include "nav.html"\n'
+        self.loader.mapping['nav.html'] = '%nav\n'
+
+        html = self._create_env()
+        html.hamlish_inline_includes = True
+        html.hamlish_file_extensions = ('.haml', '.html')
+        env = self._create_env()
+        env.hamlish_inline_includes = True
+
+        source = self.loader.mapping['page.haml']
+        self.assertEqual(html.preprocess(source, 'page.haml'), '<nav></nav>')
+        self.assertTrue('include' in env.preprocess(source, 'page.haml'))
+
+
+    def test_overlay_methods(self):
+
+        env = self._create_env()
+        overlay = env.overlay(variable_start_string='[[',
+                              variable_end_string=']]')
+
+        t = overlay.hamlish_from_string('%p << [[ x ]]')
+        self.assertEqual(t.render(x=1), '<p>1</p>')
+        self.assertTrue(t.environment is overlay)
+
+        t = env.hamlish_from_string('%p << {{ x }}')
+        self.assertEqual(t.render(x=1), '<p>1</p>')
+        self.assertTrue(t.environment is env)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from jinja2 import Environment, DictLoader
+from hamlish_jinja import HamlishExtension, ConversionCache, SQLiteStore
+
+import testing_base
+
+
+conversions = []
+
+def upper(text):
+    conversions.append(text)
+    return text.upper()
+
+
+class TestSQLiteStore(testing_base.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'hamlish.db')
+        self.store = SQLiteStore(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.dir)
+
+
+    def test_mapping(self):
+
+        self.assertEqual(len(self.store), 0)
+        self.assertFalse('a' in self.store)
+        self.assertEqual(self.store.get('a'), None)
+        self.assertRaises(KeyError, lambda: self.store['a'])
+
+        self.store['a'] = 'one'
+        self.store['a'] = 'two'
+        self.assertTrue('a' in self.store)
+        self.assertEqual(self.store['a'], 'two')
+        self.assertEqual(len(self.store), 1)
+
+        del self.store['a']
+        self.assertFalse('a' in self.store)
+
+        def delete():
+            del self.store['a']
+        self.assertRaises(KeyError, delete)
+
+
+    def test_shared_between_connections(self):
+
+        self.store['a'] = 'one'
+
+        other = SQLiteStore(self.path)
+        try:
+            self.assertEqual(other['a'], 'one')
+        finally:
+            other.close()
+
+
+    def test_max_entries(self):
+
+        store = SQLiteStore(self.path, max_entries=2, touch_interval=0)
+        try:
+            store['a'] = '1'
+            store['b'] = '2'
+            store.get('a')
+            store['c'] = '3'
+
+            self.assertEqual(len(store), 2)
+            self.assertTrue('a' in store)
+            self.assertFalse('b' in store)
+            self.assertTrue('c' in store)
+        finally:
+            store.close()
+
+
+    def test_reads_within_interval(self):
+
+        self.store['a'] = 'one'
+        used = self._used('a')
+
+        self.store.get('a')
+        self.assertEqual(self._used('a'), used)
+
+        self.store.touch_interval = 0
+        self.store.get('a')
+        self.assertTrue(self._used('a') > used)
+
+
+    def _used(self, key):
+        conn = sqlite3.connect(self.path)
+        try:
+            return conn.execute('SELECT used FROM hamlish_store WHERE key = ?',
+                                (key,)).fetchone()[0]
+        finally:
+            conn.close()
+
+
+    def test_clear(self):
+
+        self.store['a'] = 'one'
+        self.store.clear()
+        self.assertEqual(len(self.store), 0)
+
+
+class TestStoredConversions(testing_base.TestCase):
+
+    def setUp(self):
+
+        self.dir = tempfile.mkdtemp()
+        self.store = SQLiteStore(os.path.join(self.dir, 'hamlish.db'))
+        self.templates = {
+            'page.haml': '%p\n  :upper\n    hello\n',
+            'base.haml': '%div\n  -block body\n',
+            'child.haml': '-extends "base.haml"\n-block body\n  %p child\n',
+        }
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.dir)
+
+
+    def _create_env(self, filters=None):
+
+        env = Environment(extensions=[HamlishExtension],
+            loader=DictLoader(self.templates))
+        env.hamlish_filters = filters or {'upper': upper}
+        env.hamlish_conversion_cache = ConversionCache(store=self.store)
+
+        return env
+
+
+    def test_shared_between_caches(self):
+
+        del conversions[:]
+
+        env = self._create_env()
+        self.assertEqual(env.get_template('page.haml').render(), '<p>HELLO</p>')
+        self.assertEqual(len(self.store), 1)
+
+        # Another process starts with an empty cache in memory
+        other = self._create_env()
+        self.assertEqual(other.get_template('page.haml').render(),
+            '<p>HELLO</p>')
+        self.assertEqual(len(conversions), 1)
+
+
+    def test_dependencies(self):
+
+        env = self._create_env()
+        env.get_template('child.haml').render()
+
+        other = self._create_env()
+        other.get_template('child.haml')
+        self.assertEqual(other.hamlish_dependencies.dependencies('child.haml'),
+            set(['base.haml']))
+
+
+    def test_changed_source(self):
+
+        self._create_env().get_template('page.haml')
+
+        self.templates['page.haml'] = '%p\n  changed\n'
+        t = self._create_env().get_template('page.haml')
+        self.assertEqual(t.render(), '<p>changed</p>')
+
+
+    def test_unstorable_configuration(self):
+
+        env = self._create_env({'upper': lambda text: text.upper()})
+        self.assertEqual(env.get_template('page.haml').render(), '<p>HELLO</p>')
+        self.assertEqual(len(self.store), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+import io
+import unittest
+
+from jinja2 import TemplateSyntaxError
+from hamlish_jinja import Hamlish, Output
+
+import testing_base
+
+
+def javascript_filter(text):
+    return '<script>\n' + text + '\n</script>'
+
+
+source = '''
+-extends "base.haml"
+
+-block content
+    %ul#list
+        -for item in items:
+            %li.item -> =item
+        -else
+            %li << empty
+
+    -if a
+    -elif b
+        %p
+            Text \\
+            continued
+
+    ; comment
+    %pre
+        |def test():
+        |    pass
+    :javascript
+        var a = 1;
+
+            var b = 2;
+    %br
+    %p
+'''
+
+
+class TestStreaming(testing_base.TestCase):
+
+    modes = [
+        dict(indent_string='', newline_string=''),
+        dict(indent_string='  ', newline_string='\n'),
+        dict(indent_string='   ', newline_string='\n', debug=True),
+    ]
+
+    def _stream(self, hamlish, source):
+        output = io.StringIO()
+        hamlish.convert_file(io.StringIO(source), output)
+        return output.getvalue()
+
+    def test_same_output_as_convert_source(self):
+
+        for mode in self.modes:
+            hamlish = Hamlish(Output(**mode), True,
+                              {'javascript': javascript_filter})
+
+            self.assertEqual(
+                self._stream(hamlish, source), hamlish.convert_source(source))
+
+
+    def test_output_is_written_incrementally(self):
+
+        output = io.StringIO()
+        written = []
+
+        def lines():
+            for i in range(1000):
+                written.append(len(output.getvalue()))
+                yield '%div\n'
+                yield '    %p -> =item\n'
+
+        self.hamlish.convert_file(lines(), output)
+
+        self.assertEqual(written[0], 0)
+        self.assertTrue(written[-1] > 0)
+        self.assertEqual(output.getvalue(),
+                         self._h('%div\n    %p -> =item\n' * 1000))
+
+
+    def test_errors(self):
+
+        self.assertRaises(TemplateSyntaxError, self._stream, self.hamlish,
+                          '%br\n  %p\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
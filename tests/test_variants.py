@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from jinja2 import Environment, DictLoader, select_autoescape
+from hamlish_jinja import HamlishExtension, HamlishLoader, ConversionCache
+
+import testing_base
+
+
+class TestVariants(testing_base.TestCase):
+
+    def setUp(self):
+
+        self.templates = {
+            'page.haml': '\n'.join([
+                '-if dir == "rtl"',
+                '  %p dir="rtl" << {{ text }}',
+                '-else',
+                '  %p << {{ text }}',
+            ]),
+        }
+
+        self.env = Environment(
+            extensions=[HamlishExtension],
+            loader=HamlishLoader(DictLoader(self.templates)),
+            auto_reload=True)
+        self.env.hamlish_conversion_cache = ConversionCache()
+        self.env.hamlish_variants = {
+            'ltr': {'dir': 'ltr'},
+            'rtl': {'dir': 'rtl'},
+        }
+
+
+    def _source(self, name):
+        source = self.env.loader.get_source(self.env, name)[0]
+        return self.env.preprocess(source, name)
+
+
+    def test_variants(self):
+
+        self.assertEqual(self._source('page.haml@rtl'),
+            '<p dir="rtl">{{ text }}</p>')
+        self.assertEqual(self._source('page.haml@ltr'), '<p>{{ text }}</p>')
+
+        t = self.env.hamlish_get_variant('page.haml', 'rtl')
+        self.assertEqual(t.render(text='x'), '<p dir="rtl">x</p>')
+        self.assertEqual(t.name, 'page.haml@rtl')
+
+        t = self.env.get_template('page.haml')
+        self.assertEqual(t.render(text='x', dir='rtl'), '<p dir="rtl">x</p>')
+
+
+    def test_separate_cache_entries(self):
+
+        rtl = self.env.hamlish_get_variant('page.haml', 'rtl')
+        ltr = self.env.hamlish_get_variant('page.haml', 'ltr')
+
+        self.assertFalse(rtl is ltr)
+        self.assertTrue(rtl is self.env.hamlish_get_variant('page.haml', 'rtl'))
+
+
+    def test_unknown_variant(self):
+
+        self.assertRaises(ValueError,
+            self.env.hamlish_get_variant, 'page.haml', 'other')
+
+
+    def test_reload(self):
+
+        self.env.hamlish_get_variant('page.haml', 'rtl')
+        self.templates['page.haml'] = '-if dir == "rtl"\n  %span\n'
+
+        t = self.env.hamlish_get_variant('page.haml', 'rtl')
+        self.assertEqual(t.render(), '<span></span>')
+        self.assertEqual(self.env.hamlish_invalidate('page.haml'),
+            set(['page.haml', 'page.haml@rtl']))
+
+
+    def test_autoescape(self):
+
+        env = Environment(
+            extensions=[HamlishExtension],
+            loader=HamlishLoader(DictLoader(self.templates)),
+            autoescape=select_autoescape(['haml']))
+        env.hamlish_variants = {'rtl': {'dir': 'rtl'}}
+
+        t = env.get_template('page.haml')
+        self.assertEqual(t.render(text='<b>'), '<p>&lt;b&gt;</p>')
+
+        t = env.hamlish_get_variant('page.haml', 'rtl')
+        self.assertEqual(t.render(text='<b>'), '<p dir="rtl">&lt;b&gt;</p>')
+
+        overlay = env.overlay()
+        t = overlay.hamlish_get_variant('page.haml', 'rtl')
+        self.assertEqual(t.render(text='<b>'), '<p dir="rtl">&lt;b&gt;</p>')
+
+                # Replaced after the extension was loaded
+        env.autoescape = select_autoescape(['haml'])
+        env.cache.clear()
+        t = env.hamlish_get_variant('page.haml', 'rtl')
+        self.assertEqual(t.render(text='<b>'), '<p dir="rtl">&lt;b&gt;</p>')
+
+
+    def test_autoescape_without_variants(self):
+
+        autoescape = select_autoescape(['haml'])
+        env = Environment(extensions=[HamlishExtension],
+            loader=DictLoader(self.templates), autoescape=autoescape)
+
+        env.get_template('page.haml')
+        self.assertTrue(env.autoescape is autoescape)
+        self.assertTrue(env.overlay().autoescape is autoescape)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+import gc
+import unittest
+
+from jinja2 import Environment, DictLoader
+from hamlish_jinja import HamlishExtension
+
+import testing_base
+
+
+class TestWarmUp(testing_base.TestCase):
+
+    def setUp(self):
+
+        self.loader = DictLoader({
+            'base.haml': '%div\n  -block body\n',
+            'page.haml': '-extends "base.haml"\n-block body\n  %p\n    page\n',
+            'plain.html': '<p>plain</p>',
+        })
+
+        self.converted = []
+        self.env = Environment(extensions=[HamlishExtension],
+            loader=self.loader, cache_size=1)
+
+        ext = self.env.extensions[HamlishExtension.identifier]
+        convert_source = ext._convert_source
+        def count(source, name, filename=None):
+            self.converted.append(name)
+            return convert_source(source, name, filename)
+        ext._convert_source = count
+
+
+    def _cached(self):
+        return sorted(key[1] for key in self.env.cache.keys())
+
+
+    def test_all_templates(self):
+
+        names = self.env.hamlish_warm_up(freeze=False)
+
+        self.assertEqual(names, ['base.haml', 'page.haml'])
+        self.assertEqual(self._cached(), ['base.haml', 'page.haml'])
+
+        self.assertEqual(self.env.get_template('page.haml').render(),
+            '<div><p>page</p></div>')
+        self.assertEqual(sorted(self.converted), ['base.haml', 'page.haml'])
+
+
+    def test_names(self):
+
+        names = self.env.hamlish_warm_up(['page.haml'], freeze=False)
+
+        self.assertEqual(names, ['page.haml'])
+        self.assertEqual(self._cached(), ['page.haml'])
+
+
+    def test_file_extensions(self):
+
+        self.env.hamlish_file_extensions = ('.haml', '.html')
+        names = self.env.hamlish_warm_up(freeze=False)
+
+        self.assertEqual(names, ['base.haml', 'page.haml', 'plain.html'])
+
+
+    def test_overlay(self):
+
+        overlay = self.env.overlay()
+        overlay.hamlish_warm_up(freeze=False)
+
+        self.assertEqual(sorted(k[1] for k in overlay.cache.keys()),
+            ['base.haml', 'page.haml'])
+
+
+    @unittest.skipUnless(hasattr(gc, 'freeze'), 'needs gc.freeze')
+    def test_freeze(self):
+
+        try:
+            self.env.hamlish_warm_up()
+            self.assertTrue(gc.get_freeze_count() > 0)
+        finally:
+            gc.unfreeze()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from jinja2 import Environment
+from hamlish_jinja import Hamlish, Output, HamlishExtension
+
+import testing_base
+
+
+class TestWhitespaceControl(testing_base.TestCase):
+
+    def setUp(self):
+        self.hamlish = Hamlish(
+            Output(indent_string='  ', newline_string='\n',
+                   whitespace_control=True))
+
+
+    def test_jinja_tags(self):
+
+        s = self._h('''
+%ul
+  -for i in items
+    %li << {{ i }}
+  -else
+    %li << none
+''')
+        r = '''\
+<ul>
+  {%- for i in items -%}
+    <li>{{ i }}</li>
+  {%- else -%}
+    <li>none</li>
+  {%- endfor -%}
+</ul>'''
+
+        self.assertEqual(s, r)
+
+
+    def test_custom_delimiters(self):
+
+        env = Environment(extensions=[HamlishExtension],
+            block_start_string='<%', block_end_string='%>')
+        env.hamlish_mode = 'indented'
+        env.hamlish_whitespace_control = True
+
+        s = env.preprocess('%p\n  -if a\n    text\n', 'test.haml')
+        self.assertEqual(s,
+            '<p>\n    <%- if a -%>\n        text\n    <%- endif -%>\n</p>')
+        self.assertEqual(env.from_string(s).render(a=True), '<p>text</p>')
+
+
+    def test_rendered_like_compact(self):
+
+        source = '%div\n  -for i in items\n    %span << {{ i }}\n'
+
+        env = Environment(extensions=[HamlishExtension])
+        compact = env.from_string(env.preprocess(source, 'test.haml'))
+
+        env.hamlish_mode = 'indented'
+        env.hamlish_whitespace_control = True
+        indented = env.from_string(env.preprocess(source, 'test.haml'))
+
+        self.assertEqual(indented.render(items=[1, 2]),
+            compact.render(items=[1, 2]))
+
+
+if __name__ == '__main__':
+    unittest.main()